@@ -0,0 +1,51 @@
+#!/bin/bash
+# Measure the scaling of the sharded codet5p metric over the number of worker
+# processes on a sample of the function database. The sample is copied, so the
+# function database itself is not modified. Its score store and index are
+# kept next to it in the temporary directory, and each run recalculates all
+# scores.
+
+set -e
+
+source env/bin/activate
+
+data_dir=./data
+functions=$data_dir/functions/
+nfunctions=${NFUNCTIONS:-8192}
+nprocs_list=${NPROCS_LIST:-"1 2 4 8 16 32 64"}
+ncpus=$(nproc)
+
+tmp_dir=$(mktemp -d)
+trap "rm -rf $tmp_dir" EXIT
+sample=$tmp_dir/functions
+scores=$tmp_dir/scores
+mkdir $sample
+
+echo "[*] Copy $nfunctions functions to '$sample'"
+find $functions -mindepth 1 -maxdepth 1 -type d | head -n $nfunctions | xargs cp -r -t $sample
+# Build the index up front instead of in the first run
+python src/cli.py functions index -d $sample > /dev/null
+
+baseline=""
+printf "%8s %8s %12s %8s\n" "nprocs" "threads" "seconds" "speedup"
+for nprocs in $nprocs_list; do
+  if [ $nprocs -gt $ncpus ]; then
+    continue
+  fi
+  threads=$((ncpus / nprocs))
+  start=$(date +%s.%N)
+  python src/cli.py crashmetrics \
+    -d $sample \
+    --scores $scores \
+    --nprocs $nprocs \
+    --overwrite \
+    codet5p \
+    --threads $threads > /dev/null 2>&1
+  end=$(date +%s.%N)
+  seconds=$(echo "$end - $start" | bc)
+  if [ -z "$baseline" ]; then
+    baseline=$seconds
+  fi
+  speedup=$(echo "scale=2; $baseline / $seconds" | bc)
+  printf "%8d %8d %12.1f %8.2f\n" $nprocs $threads $seconds $speedup
+done
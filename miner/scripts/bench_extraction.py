@@ -0,0 +1,416 @@
+""" Benchmark the extraction of functions from preprocessed source files and
+their annotation, and check the results against the previous implementations.
+
+Usage: python scripts/bench_extraction.py [preprocessed file or directory ...]
+
+Without files, a synthetic C and a synthetic C++ translation unit with many
+line markers are generated. Files are expected in the format of the
+extraction, i.e., with line markers prefixed with // and the extension .c or
+.cpp.
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+# The parser libraries are loaded relative to the source directory
+os.chdir(SRC_DIR)
+
+from pathlib import Path
+from utils.imfile import LineMarkers
+from utils.parsers import parser
+from utils.utils import hashdict, hashlist
+from modules.extraction import extraction
+from config import PREPARSE_DEPTH
+
+
+# Signatures of the synthetic functions by language
+SIGNATURES = {
+    "c": ["static int function_{idx}(int x) {{", "int *function_{idx}(int x) {{"],
+    "cpp": [
+        "static int function_{idx}(int x) {{",
+        "int Class{idx}::method(int x) {{",
+        "int &function_{idx}(int x) {{",
+        "bool operator==(const Class{idx} &a, int x) {{",
+    ],
+}
+
+
+def synthetic_file(fpath, nfunctions=1500):
+    random.seed(0)
+    signatures = SIGNATURES[fpath.rsplit(".", 1)[1]]
+    lines = ['//# 1 "/src/project/main.c"']
+    lineno = 1
+    for idx in range(nfunctions):
+        if idx % 4 == 0:
+            lines.append(f'//# {lineno} "/src/project/file{idx % 97}.h" 1')
+        lines.append(random.choice(signatures).format(idx=idx))
+        lines.append("  int y = x;")
+        for _ in range(random.randint(0, 8)):
+            lines.append(f'//# {lineno} "/src/project/main.c"')
+            lines.append('  if (y > 2) { y -= 1; printf("}"); }')
+        lines.append("  return y;")
+        lines.append("}")
+        lineno += 7
+    with open(fpath, "w") as f:
+        f.write("\n".join(lines))
+
+
+def linear_markers(lines):
+    """The line marker lookup before it was indexed."""
+    comments = {
+        lineno: re.search('^//# ([0-9]+) "(.+)" ([0-9]+).*', line + " 1" if line.endswith('"') else line).groups(0)
+        for lineno, line in enumerate(lines, start=1)
+        if re.match('^//# [0-9]+ "', line) != None
+    }
+    linenums = sorted(comments)
+
+    def pp_to_real(pp_lineno):
+        pp_lineno += 1
+        before = list(filter(lambda lineno: lineno < pp_lineno, linenums))
+        if len(before) == 0:
+            return None
+        comment_lineno = max(before)
+        closest_lineno, fname, flags = comments[comment_lineno]
+        return fname, flags, int(closest_lineno) + (pp_lineno - comment_lineno - 1)
+
+    def unmarked_lines(start, end):
+        return [line for line in lines[start:end] if re.match('^//# [0-9]+ "', line) == None]
+
+    return pp_to_real, unmarked_lines
+
+
+def char_loop_block_tree(data, max_depth):
+    """The block pre-parser before it was based on a regular expression."""
+    data = data.decode("utf-8", errors="ignore")
+    root_node = hashdict(start=0, end=len(data), children=[], parent=None)
+    current_node = root_node
+    in_double_quotes = False
+    in_single_quotes = False
+    escape = False
+    depth = 0
+    for idx in range(0, len(data)):
+        if escape:
+            escape = False
+            continue
+        if data[idx] == "\\":
+            escape = True
+            continue
+        if not in_single_quotes and data[idx] == '"':
+            in_double_quotes ^= True
+            continue
+        if not in_double_quotes and data[idx] == "'":
+            in_single_quotes ^= True
+            continue
+        if in_double_quotes or in_single_quotes:
+            continue
+        if data[idx] == "{":
+            if depth < max_depth:
+                node = hashdict(start=idx, end=None, children=[], parent=current_node)
+                current_node["children"].append(node)
+                current_node = node
+            depth += 1
+            continue
+        if data[idx] == "}":
+            depth -= 1
+            if depth < max_depth:
+                current_node["end"] = idx + 1
+                current_node = current_node["parent"]
+    return root_node
+
+
+def decode_per_block_functions(data, lang):
+    """The function extraction before it worked on a single buffer."""
+
+    def node_iter_functions(node):
+        for child in node["children"]:
+            yield from node_iter_functions(child)
+        adjusted_block_start, block_end = parser.expand_backwards(
+            data, [(node["start"], node["end"])]
+        )[0]
+        line_offset = max(
+            0,
+            len(data.decode("utf-8", errors="ignore")[:adjusted_block_start].split("\n"))
+            - 1,
+        )
+        functions = parser.treesitter_iter_functions_bytes(
+            data.decode("utf-8", errors="ignore")[adjusted_block_start:block_end].encode(
+                "utf-8"
+            ),
+            lang,
+        )
+        for function in functions:
+            function["start"] += line_offset
+            function["end"] += line_offset
+            yield function
+
+    root_node = parser.create_block_tree(data, PREPARSE_DEPTH)
+    functions = {}
+    for function in node_iter_functions(root_node):
+        if function["end"] not in functions:
+            functions[function["end"]] = function
+        elif function["start"] > functions[function["end"]]["start"]:
+            functions[function["end"]] = function
+    return list(functions.values())
+
+
+# The queries of the parser before the names were captured along with the
+# functions. The others are still those of the parser.
+QUERY_FUNCS_C = parser.C_LANGUAGE.query(
+    """
+(function_definition
+  [
+    (function_declarator
+      (identifier)
+    )
+    (pointer_declarator
+      (function_declarator
+        (identifier)
+      )
+    )
+  ]
+) @function
+"""
+)
+QUERY_FUNC_NAME_C = parser.C_LANGUAGE.query(
+    """
+(function_definition
+  [
+    (function_declarator
+      (identifier) @name
+    )
+    (pointer_declarator
+      (function_declarator
+        (identifier) @name
+      )
+    )
+  ]
+)
+"""
+)
+
+QUERY_FUNC_IDENTIFIER_SUBTREE = parser.CPP_LANGUAGE.query(
+    """
+(function_definition 
+  [
+    (function_declarator (identifier) @subtree)
+    (function_declarator (qualified_identifier) @subtree)
+    (function_declarator (operator_name) @subtree)
+    (function_declarator (field_identifier) @subtree)
+    (pointer_declarator (function_declarator (identifier) @subtree))
+    (pointer_declarator (function_declarator (qualified_identifier) @subtree))
+    (pointer_declarator (function_declarator (operator_name) @subtree))
+    (pointer_declarator (function_declarator (field_identifier) @subtree))
+    (reference_declarator (function_declarator (identifier) @subtree))
+    (reference_declarator (function_declarator (qualified_identifier) @subtree))
+    (reference_declarator (function_declarator (operator_name) @subtree))
+    (reference_declarator (function_declarator (field_identifier) @subtree))
+  ]
+)
+"""
+)
+
+def per_function_query_functions(data, lang):
+    """The functions of a syntax tree before the names were captured along with
+    the functions, parsed with a new parser.
+    """
+
+    def get_name(function, is_cpp):
+        if is_cpp:
+            subtrees = QUERY_FUNC_IDENTIFIER_SUBTREE.captures(function)
+            if len(subtrees) != 1:
+                return ""
+            subtree, _ = subtrees[0]
+            name_matches = parser.QUERY_FUNC_NAME_CPP.captures(subtree)
+        else:
+            name_matches = QUERY_FUNC_NAME_C.captures(function)
+        if len(name_matches) != 1:
+            return ""
+        return name_matches[0][0].text.decode("ascii")
+
+    ts_parser = parser.Parser()
+    ts_parser.set_language(parser.LANGUAGES[lang])
+    tree = ts_parser.parse(data)
+    if lang == "c":
+        functions = QUERY_FUNCS_C.captures(tree.root_node)
+    elif lang == "cpp":
+        functions = parser.QUERY_FUNCS_CPP.captures(tree.root_node)
+    return [
+        hashdict(
+            name=get_name(function, is_cpp=lang == "cpp"),
+            start=function.start_point[0],
+            end=function.end_point[0] + 1,
+            start_col=function.start_point[1],
+            end_col=function.end_point[1],
+        )
+        for function, _ in functions
+    ]
+
+
+def synthetic_annotation(nfunctions=20000, nframes=60):
+    random.seed(0)
+    dirs = ["/src/project", "/src/project/lib", "/src/project/./lib", "/src/other", "/src/project//lib"]
+    names = [f"file{idx}.c" for idx in range(40)]
+    functions = set()
+    for idx in range(nfunctions):
+        start = random.randint(1, 2000)
+        origin = hashdict(
+            fpath=f"{random.choice(dirs)}/{random.choice(names)}",
+            name=f"function_{idx}",
+            start=start,
+            end=start + random.randint(0, 80),
+            flags=1,
+        )
+        functions.add(hashdict(origin=origin, source=str(idx)))
+    traceback = [
+        {
+            "frameno": frameno,
+            "function": {
+                "fpath": f"{random.choice(dirs)}/{random.choice(names)}",
+                "linenum": random.randint(1, 2100),
+            },
+        }
+        for frameno in range(nframes)
+    ]
+    return functions, traceback
+
+
+def pairwise_annotation(functions, traceback):
+    """The annotation before the frames were indexed."""
+
+    def func_equal(func1, func2):
+        fpath1 = func1["fpath"]
+        fpath2 = func2["origin"]["fpath"]
+        certainty = 0
+        path_eq = False
+        if os.path.normpath(fpath1) == os.path.normpath(fpath2):
+            certainty += 1
+            path_eq = True
+        elif os.path.basename(fpath1) == os.path.basename(fpath2):
+            certainty += 0.5
+            path_eq = True
+        function_eq = func2["origin"]["start"] <= func1["linenum"] <= func2["origin"]["end"]
+        certainty += function_eq
+        return path_eq and function_eq, certainty
+
+    annotations = {}
+    for function in functions:
+        annotation = hashdict(frameno=-1, framenos=hashlist(), crashsite=False)
+        frames = [(func_equal(frame["function"], function), frame) for frame in traceback]
+        frames = [frame for frame in frames if frame[0][0]]
+        if len(frames) >= 1:
+            max_certainty = max(frames, key=lambda el: el[0][1])[0][1]
+            frames = [frame for (_, certainty), frame in frames if certainty == max_certainty]
+            annotation = hashdict(
+                frameno=frames[0]["frameno"],
+                framenos=hashlist(frame["frameno"] for frame in frames),
+                crashsite=frames[0]["frameno"] == 0,
+            )
+        annotations[function["source"]] = annotation
+    return annotations
+
+
+def flatten_block_tree(node, depth=0):
+    yield depth, node["start"], node["end"]
+    for child in node["children"]:
+        yield from flatten_block_tree(child, depth + 1)
+
+
+def timed(name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"{name:<40} {time.perf_counter() - start:10.3f}s")
+    return result
+
+
+def bench_line_markers(lines, functions):
+    def run(pp_to_real, unmarked_lines):
+        return [
+            (
+                pp_to_real(function["start"]),
+                pp_to_real(function["end"]),
+                unmarked_lines(function["start"] + 1, function["end"] - 1),
+            )
+            for function in functions
+        ]
+
+    expected = timed("line markers (linear)", lambda: run(*linear_markers(lines)))
+    markers = LineMarkers(lines)
+    result = timed("line markers (bisect)", lambda: run(markers.pp_to_real, markers.unmarked_lines))
+    assert result == expected, "Line marker lookups differ"
+
+
+def bench_block_tree(data):
+    expected = timed("block tree (char loop)", char_loop_block_tree, data, PREPARSE_DEPTH)
+    result = timed("block tree (regex)", parser.create_block_tree, data, PREPARSE_DEPTH)
+    assert list(flatten_block_tree(result)) == list(flatten_block_tree(expected)), "Block trees differ"
+
+
+def bench_functions(data, lang):
+    expected = timed("functions (decode per block)", decode_per_block_functions, data, lang)
+    result = timed("functions (single buffer)", parser.iter_functions_bytes, data, lang)
+    assert result == expected, "Extracted functions differ"
+    return result
+
+
+def bench_function_names(data, lang):
+    expected = timed("tree functions (query per function)", per_function_query_functions, data, lang)
+    result = timed(
+        "tree functions (single query)",
+        lambda: list(parser.treesitter_iter_functions_tree(parser.parse_bytes(data, lang), lang)),
+    )
+    assert result == expected, "Functions of the syntax tree differ"
+
+
+def bench_annotation():
+    functions, traceback = synthetic_annotation()
+    expected = timed("annotation (pairwise)", pairwise_annotation, functions, traceback)
+    functions = timed("annotation (frame index)", extraction.annotate_functions, functions, traceback)
+    result = {function["source"]: function["annotation"] for function in functions}
+    assert result == expected, "Annotations differ"
+    annotated = sum(annotation["frameno"] >= 0 for annotation in result.values())
+    print(f"[*] {len(result)} functions, {annotated} annotated")
+
+
+def source_files(paths):
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(
+                fpath for fpath in path.rglob("*") if fpath.suffix in [".c", ".cpp"]
+            )
+        else:
+            yield path
+
+
+def main():
+    if len(sys.argv) > 1:
+        fpaths = [str(fpath.absolute()) for fpath in source_files(sys.argv[1:])]
+    else:
+        directory = tempfile.mkdtemp()
+        fpaths = [os.path.join(directory, f"synthetic.{lang}") for lang in SIGNATURES]
+        for fpath in fpaths:
+            synthetic_file(fpath)
+
+    bench_annotation()
+    for fpath in fpaths:
+        print(f"[*] {fpath}")
+        with open(fpath, "rb") as f:
+            data = f.read()
+        with open(fpath, "r", encoding="utf-8", errors="ignore") as f:
+            lines = f.read().split("\n")
+        bench_block_tree(data)
+
+        lang = fpath.rsplit(".", 1)[1]
+        bench_function_names(data, lang)
+        functions = bench_functions(data, lang)
+        print(f"[*] {len(lines)} lines, {len(functions)} functions")
+        bench_line_markers(lines, functions)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+""" Benchmark the matching of function paths to source files and check it
+against the previous pairwise matching.
+
+Usage: python scripts/bench_matching.py [directory]
+
+The source files of the directory, or a synthetic checkout without one, are
+matched with the paths of randomly chosen files under a different prefix,
+as well as with paths which only share their file name.
+"""
+
+import os
+import sys
+import time
+import random
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+# Directories are given relative to the working directory of the caller
+CALLER_DIR = os.getcwd()
+os.chdir(SRC_DIR)
+
+from pathlib import Path
+from utils.pathmatcher import PathMatcher
+
+
+def synthetic_checkout(nfiles=20000):
+    random.seed(0)
+    dirs = ["src", "lib", "include", "test", "util", "core", "io", "net"]
+    names = [f"file{idx}" for idx in range(nfiles // 8)] + ["main", "util", "common"]
+    return [
+        "/tmp/checkout/"
+        + "/".join(random.sample(dirs, random.randint(0, 4)))
+        + f"/{random.choice(names)}.{random.choice(['c', 'h', 'cc'])}"
+        for _ in range(nfiles)
+    ]
+
+
+def get_first_mismatch(it1, it2):
+    for idx, (el1, el2) in enumerate(zip(it1, it2)):
+        if el1 != el2:
+            return idx
+    return min(len(it1), len(it2))
+
+
+def pairwise_match(fpath, source_files):
+    """The matching of recent_changes before the source files were indexed."""
+    scored_files = [
+        (idx, get_first_mismatch(fpath[::-1], source_file[::-1]))
+        for idx, source_file in enumerate(source_files)
+    ]
+    idx, _ = max(scored_files, key=lambda el: el[1])
+    if Path(fpath).name != Path(source_files[idx]).name:
+        return None
+    return idx
+
+
+def timed(name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"{name:<40} {time.perf_counter() - start:10.3f}s")
+    return result
+
+
+def main():
+    if len(sys.argv) > 1:
+        directory = Path(CALLER_DIR) / sys.argv[1]
+        source_files = [str(path) for path in sorted(directory.rglob("*")) if path.is_file()]
+    else:
+        source_files = synthetic_checkout()
+
+    random.seed(1)
+    fpaths = [
+        "/src/project" + fpath[random.randint(0, len(fpath) - 1) :]
+        for fpath in random.sample(source_files, min(500, len(source_files)))
+    ]
+    fpaths += [f"/src/project/{Path(fpath).name}" for fpath in fpaths[:100]]
+    fpaths += ["/src/project/missing.c", Path(source_files[0]).name]
+
+    expected = timed("match (pairwise)", lambda: [pairwise_match(fpath, source_files) for fpath in fpaths])
+    matcher = timed("index (trie)", PathMatcher, source_files)
+    result = timed("match (trie)", lambda: [matcher.match(fpath) for fpath in fpaths])
+    assert result == expected, "Matched source files differ"
+    matched = sum(idx != None for idx in result)
+    print(f"[*] {len(source_files)} source files, {matched}/{len(fpaths)} paths matched")
+
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,7 @@ filter=$data_dir/filter
 database=$data_dir/database/
 functions=$data_dir/functions/
 testcases=$data_dir/testcases/
+extraction_cache=$data_dir/extraction-cache/
 
 nprocs=4
 
@@ -48,5 +49,6 @@ python src/cli.py extraction \
 	-o $functions \
 	-f $filter \
 	--nprocs $nprocs \
+	--cache $extraction_cache \
 	--progress 2> $extraction_log
 echo ""
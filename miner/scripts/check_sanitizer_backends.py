@@ -0,0 +1,75 @@
+""" Compare the sanitizer calls counted by the objdump and the elf backend.
+
+Usage: python scripts/check_sanitizer_backends.py <binary> [binary ...]
+
+The functions of each binary are matched by their mangled name and address,
+and differences of their ranges or sanitizer calls are reported.
+"""
+
+import os
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+# Binaries are given relative to the working directory of the caller
+CALLER_DIR = os.getcwd()
+os.chdir(SRC_DIR)
+
+from modules.crashmetrics import sanitizer
+
+
+def timed(name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"{name:<40} {time.perf_counter() - start:10.3f}s")
+    return result
+
+
+def functions_by_backend(fpath, backend):
+    functions = timed(f"functions ({backend})", lambda: list(sanitizer.BACKENDS[backend](fpath)))
+    return {
+        (function.mangled_name, function.low_pc): (function.high_pc, function.scores)
+        for function in functions
+    }
+
+
+def compare(fpath, max_reports=10):
+    expected = functions_by_backend(fpath, "objdump")
+    result = functions_by_backend(fpath, "elf")
+
+    only_objdump = sorted(set(expected) - set(result), key=lambda key: key[1])
+    only_elf = sorted(set(result) - set(expected), key=lambda key: key[1])
+    both = sorted(set(expected) & set(result), key=lambda key: key[1])
+    ranges = [key for key in both if expected[key][0] != result[key][0]]
+    scores = [key for key in both if expected[key][1] != result[key][1]]
+
+    print(f"[*] {len(expected)} functions (objdump), {len(result)} functions (elf)")
+    for name, keys in [
+        ("only found by objdump", only_objdump),
+        ("only found by elf", only_elf),
+        ("different ranges", ranges),
+        ("different sanitizer calls", scores),
+    ]:
+        if len(keys) == 0:
+            continue
+        print(f"[!] {len(keys)} functions {name}")
+        for key in keys[:max_reports]:
+            print(f"    {key[0]} at {key[1]:#x}: {expected.get(key)} {result.get(key)}")
+    return len(only_objdump) + len(only_elf) + len(ranges) + len(scores) == 0
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    identical = True
+    for fpath in sys.argv[1:]:
+        print(f"[*] {fpath}")
+        identical &= compare(os.path.join(CALLER_DIR, fpath))
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == "__main__":
+    main()
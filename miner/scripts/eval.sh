@@ -10,8 +10,9 @@ output_path=${output_dir}/mean-ndcg.png
 
 metric=all
 maxcutoff=1000
+nprocs=1
 
 mkdir -p ${output_dir}
 
 echo "[+] Create the mean-NDCG plot at '${output_path}' for metric '${metric}'"
-python src/cli.py evaluate --functions ${data_dir}/functions -o ${output_path} --metric ${metric} --topn ${maxcutoff}
+python src/cli.py evaluate --functions ${data_dir}/functions -o ${output_path} --metric ${metric} --topn ${maxcutoff} --nprocs ${nprocs}
@@ -8,9 +8,15 @@ nprocs=1
 data_dir=./data
 functions=$data_dir/functions/
 database=$data_dir/database/
+sanitizer_cache=$data_dir/sanitizer-cache/
 scorings_without_crash_db="codet5p cppcheck rats complexity vulnerability random"
 scorings_with_crash_db="recent-changes sanitizers"
 
+# Index the function database
+python src/cli.py functions index \
+  -d $functions \
+  --progress
+
 # Calculate scores
 for scoring in $scorings_without_crash_db; do
   echo "[*] Calculate '$scoring' scores"
@@ -24,12 +30,17 @@ done
 if [ -d ${database} ]; then
   for scoring in $scorings_with_crash_db; do
     echo "[*] Calculate '$scoring' scores"
+    scoring_args=""
+    if [ "$scoring" == "sanitizers" ]; then
+      scoring_args="--cache $sanitizer_cache"
+    fi
     python src/cli.py crashmetrics \
       -d $functions \
       --nprocs $nprocs \
       --progress \
       $scoring \
-      --crash-database $database
+      --crash-database $database \
+      $scoring_args
   done
 else
   echo "[!] The metrics '${scorings_with_crash_db}' cannot be calculated as they require the full database from scraping."
@@ -37,5 +48,5 @@ else
 fi
 
 # Set missing scores
-python src/cli.py missingscores \
+python src/cli.py missingscores --export \
   -d $functions
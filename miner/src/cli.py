@@ -5,6 +5,7 @@ from modules.regress import regress
 from modules.extraction import extraction
 from modules.crashmetrics import crashmetrics
 from modules.crashmetrics import missingscores
+from modules.functions import functions
 from modules.evaluate import evaluate
 from modules.metricdata import metricdata
 
@@ -20,6 +21,7 @@ if __name__ == "__main__":
     cli.add_command(extraction.cli, "extraction")
     cli.add_command(crashmetrics.cli, "crashmetrics")
     cli.add_command(missingscores.cli, "missingscores")
+    cli.add_command(functions.cli, "functions")
     cli.add_command(evaluate.cli, "evaluate")
     cli.add_command(metricdata.cli, "metricdata")
     cli()
@@ -1,9 +1,33 @@
+import os
+import sys
+import multiprocessing as mp
+import functools as ft
 import torch
 import transformers
 from pathlib import Path
 from fsdict import fsdict
 from tqdm import tqdm
 
+from utils.utils import *
+from utils.tokencache import TokenCache
+from utils.sourcestore import FunctionSources
+
+
+MODEL_NAME = "Salesforce/codet5p-220m"
+CHECKPOINT_PATH = "assets/model_normalized.bin"
+
+# Reduced precision modes for CPU inference. On GPUs we always use fp16
+# autocasting.
+PRECISIONS = ["fp32", "bf16", "int8"]
+
+# Number of functions which are tokenized and sorted by length at once, before
+# they are split into batches.
+BUCKET_WINDOW = 8192
+
+# Number of functions a sharded worker scores per task. Smaller shards balance
+# the load better, larger shards allow for better length bucketing.
+SHARD_SIZE = 2048
+
 
 # from https://github.com/salesforce/CodeT5/blob/d929a71f98ba58491948889d554f8276c92f98ae/CodeT5/models.py#LL123C1-L181C24
 class DefectModel(transformers.PreTrainedModel):
@@ -41,7 +65,9 @@ class DefectModel(transformers.PreTrainedModel):
         return vec
 
     def forward(self, input_ids: torch.Tensor, attention_mask=None, labels=None):
-        input_ids = input_ids.view(-1, self.tokenizer.model_max_length)
+        # Batches are only padded to their longest sequence, not to the
+        # tokenizer's model_max_length.
+        input_ids = input_ids.view(-1, input_ids.size(-1))
         vec = self.get_t5_vec(input_ids, attention_mask=attention_mask)
 
         logits = self.classifier(vec)
@@ -54,26 +80,7 @@ class DefectModel(transformers.PreTrainedModel):
             return prob
 
 
-@torch.no_grad()
-def codet5p_score(input_path, tokenizer, model, device):
-    with torch.cuda.amp.autocast():  # for fp16
-        input_ids = tokenizer.encode(
-            open(str(input_path), "r").read(),
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt",
-        )
-        pred = model(input_ids.to(device)).cpu().tolist()
-
-    return pred[0][1]
-
-
-def codet5p_metric(database):
-    model_name = "Salesforce/codet5p-220m"
-    checkpoint_path = "assets/model_normalized.bin"
-
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
+def load_model(device, model_name=MODEL_NAME, checkpoint_path=CHECKPOINT_PATH):
     tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
     config_kwargs = {
         "vocab_size": len(tokenizer),
@@ -92,15 +99,249 @@ def codet5p_metric(database):
     model.eval()
     model.to(device)
 
-    for function in tqdm(database.values(), total=len(database)):
-        meta = function["meta"]
-        source_path = function.abspath / "source"
-        score = codet5p_score(source_path, tokenizer, model, device)
+    return tokenizer, model
 
-        if not "metrics" in meta:
-            meta["metrics"] = {}
-        metrics = meta["metrics"]
 
-        metrics["codet5p"] = score
-        meta["metrics"] = metrics
-        function["meta"] = meta
+def quantize(model, precision):
+    """Return the model variant to use for the given CPU precision."""
+    if precision == "int8":
+        return torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model
+
+
+def autocast(device, precision):
+    if device.type == "cuda":
+        return torch.autocast("cuda", dtype=torch.float16)
+    if precision == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return torch.autocast("cpu", enabled=False)
+
+
+def tokenize(source, tokenizer):
+    return tokenizer.encode(source, truncation=True)
+
+
+def length_buckets(lengths, batch_size, max_tokens_per_batch):
+    """Group indices of similarly long sequences into batches.
+
+    A batch holds at most batch_size sequences and, after padding to its
+    longest sequence, at most max_tokens_per_batch tokens. A single sequence
+    exceeding max_tokens_per_batch is put into a batch on its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx])
+    batches = []
+    batch = []
+    for idx in order:
+        # Sequences are sorted by length, so the current one is the longest
+        # of the batch
+        padded_size = (len(batch) + 1) * lengths[idx]
+        if len(batch) > 0 and (
+            len(batch) == batch_size or padded_size > max_tokens_per_batch
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+@torch.no_grad()
+def codet5p_scores(token_ids, tokenizer, model, device, precision="fp32"):
+    """Score a batch of tokenized functions."""
+    inputs = tokenizer.pad({"input_ids": token_ids}, return_tensors="pt")
+    with autocast(device, precision):
+        try:
+            pred = model(
+                inputs["input_ids"].to(device),
+                attention_mask=inputs["attention_mask"].to(device),
+            )
+        except ValueError:
+            # Sources containing a literal <eos> token cannot be batched
+            # with others
+            if len(token_ids) == 1:
+                raise
+            return [
+                score
+                for ids in token_ids
+                for score in codet5p_scores([ids], tokenizer, model, device, precision)
+            ]
+
+    return pred.float()[:, 1].cpu().tolist()
+
+
+def select_model(token_ids, tokenizer, model, device, precision, tolerance):
+    """Use the reduced precision model only if its scores are within the
+    tolerance of the fp32 scores for a sample of functions.
+    """
+    if device.type == "cuda" or precision == "fp32" or len(token_ids) == 0:
+        return model, precision
+
+    reduced_model = quantize(model, precision)
+    scores = codet5p_scores(token_ids, tokenizer, model, device, "fp32")
+    reduced_scores = codet5p_scores(token_ids, tokenizer, reduced_model, device, precision)
+    error = max(abs(s1 - s2) for s1, s2 in zip(scores, reduced_scores))
+    if error > tolerance:
+        print(
+            f"[!] {precision} scores deviate up to {error:.4f} from the fp32 scores (tolerance {tolerance}). Falling back to fp32.",
+            file=sys.stderr,
+        )
+        return model, "fp32"
+
+    print(f"[*] Using {precision} inference (max. deviation {error:.4f}).")
+    return reduced_model, precision
+
+
+def load_tokens(function_ids, sources, tokenizer, token_cache=None):
+    """Return the token ids of the functions, preferably from the cache."""
+    token_ids = []
+    for function_id in function_ids:
+        ids = None if token_cache == None else token_cache.get(function_id)
+        if ids is None:
+            ids = tokenize(sources.read(function_id), tokenizer)
+        else:
+            ids = ids.tolist()
+        token_ids.append(ids)
+    return token_ids
+
+
+def fill_token_cache(token_cache, function_ids, sources):
+    """Tokenize all functions which are not cached yet."""
+    missing = [
+        function_id for function_id in function_ids if not function_id in token_cache
+    ]
+    if len(missing) == 0:
+        return
+
+    print(f"[*] Tokenize {len(missing)} uncached functions")
+    for window in tqdm(chunks(missing, chunk_size=BUCKET_WINDOW)):
+        token_cache.tokenize(window, (sources.read(function_id) for function_id in window))
+        token_cache.flush()
+
+
+def score_window(function_ids, sources, tokenizer, model, device, precision, batch_size, max_tokens_per_batch, token_cache=None):
+    """Score a window of functions in length-bucketed batches."""
+    token_ids = load_tokens(function_ids, sources, tokenizer, token_cache)
+    lengths = [len(ids) for ids in token_ids]
+
+    scores = []
+    for batch in length_buckets(lengths, batch_size, max_tokens_per_batch):
+        batch_scores = codet5p_scores(
+            [token_ids[idx] for idx in batch], tokenizer, model, device, precision
+        )
+        scores += [(function_ids[idx], score) for idx, score in zip(batch, batch_scores)]
+    return scores
+
+
+def write_scores(store, scores, version):
+    for function_id, score in scores:
+        store.set(function_id, "codet5p", score, version)
+
+
+# Model and options of a sharded worker process. Each worker loads the model
+# only once.
+worker = {}
+
+
+def init_worker(threads, checkpoint, token_cache, precision, batch_size, max_tokens_per_batch):
+    torch.set_num_threads(threads)
+    device = torch.device("cpu")
+    tokenizer, model = load_model(device, checkpoint_path=checkpoint)
+    if token_cache != None:
+        token_cache = TokenCache(token_cache, tokenizer)
+    worker["token_cache"] = token_cache
+    worker["tokenizer"] = tokenizer
+    worker["model"] = quantize(model, precision)
+    worker["device"] = device
+    worker["precision"] = precision
+    worker["batch_size"] = batch_size
+    worker["max_tokens_per_batch"] = max_tokens_per_batch
+
+
+def score_shard(function_ids, sources):
+    return score_window(function_ids, sources, **worker)
+
+
+def codet5p_metric_sharded(function_ids, sources, store, version, nprocs, threads, checkpoint, token_cache, precision, batch_size, max_tokens_per_batch):
+    """Score the functions with nprocs worker processes, each running the
+    model with the given number of intra-op threads. Scores are streamed back
+    and written by this process only.
+    """
+    shards = chunks(function_ids, chunk_size=SHARD_SIZE)
+    # Forking a process which already initialized torch's thread pools might
+    # deadlock, so the workers are spawned.
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(
+        nprocs,
+        initializer=init_worker,
+        initargs=(
+            threads,
+            checkpoint,
+            token_cache,
+            precision,
+            batch_size,
+            max_tokens_per_batch,
+        ),
+    ) as p:
+        scores_it = p.imap_unordered(
+            ft.partial(score_shard, sources=sources), shards
+        )
+        with tqdm(total=len(function_ids)) as progress:
+            for scores in scores_it:
+                write_scores(store, scores, version)
+                progress.update(len(scores))
+
+
+def codet5p_metric(function_ids, database, store, version, nprocs, threads, checkpoint, token_cache, batch_size, max_tokens_per_batch, precision, tolerance):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer, model = load_model(device, checkpoint_path=checkpoint)
+    sources = FunctionSources(database)
+
+    token_cache_path = token_cache
+    if token_cache != None:
+        token_cache = TokenCache(token_cache_path, tokenizer)
+        fill_token_cache(token_cache, function_ids, sources)
+
+    # Decide on the precision with the first batch of functions
+    sample = load_tokens(function_ids[:batch_size], sources, tokenizer, token_cache)
+    model, precision = select_model(sample, tokenizer, model, device, precision, tolerance)
+
+    if nprocs > 1 and device.type == "cpu":
+        del model
+        if threads == None:
+            threads = max(1, os.cpu_count() // nprocs)
+        codet5p_metric_sharded(
+            function_ids,
+            sources,
+            store,
+            version,
+            nprocs,
+            threads,
+            checkpoint,
+            token_cache_path,
+            precision,
+            batch_size,
+            max_tokens_per_batch,
+        )
+        return
+
+    if threads != None:
+        torch.set_num_threads(threads)
+    progress = tqdm(total=len(function_ids))
+    for window in chunks(function_ids, chunk_size=BUCKET_WINDOW):
+        scores = score_window(
+            window,
+            sources,
+            tokenizer,
+            model,
+            device,
+            precision,
+            batch_size,
+            max_tokens_per_batch,
+            token_cache,
+        )
+        write_scores(store, scores, version)
+        progress.update(len(scores))
+    progress.close()
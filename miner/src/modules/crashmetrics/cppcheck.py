@@ -1,8 +1,8 @@
 import re
 from fsdict import fsdict
 from pathlib import Path
-from shutil import copy
 from utils.utils import *
+from utils.sourcestore import FunctionSources
 
 
 def calculate_score(fpath, normalize):
@@ -32,7 +32,7 @@ def calculate_score(fpath, normalize):
 
 
 @with_tempdir
-def cppcheck_metric(directory, function_ids, database, normalize):
+def cppcheck_metric(directory, function_ids, database, store, normalize, version):
     directory = Path(directory)
     in_dir = directory / "in"
     out_dir = directory / "out"
@@ -40,9 +40,9 @@ def cppcheck_metric(directory, function_ids, database, normalize):
     in_dir.mkdir()
     out_dir.mkdir()
 
+    sources = FunctionSources(database)
     for idx, function_id in enumerate(function_ids):
-        fpath = database[function_id].abspath / "source"
-        copy(fpath, in_dir / f"{idx}.c")
+        sources.write(function_id, in_dir / f"{idx}.c")
 
     cmd = [
         "docker",
@@ -58,11 +58,6 @@ def cppcheck_metric(directory, function_ids, database, normalize):
 
     for idx, function_id in enumerate(function_ids):
         fpath = out_dir / str(idx)
-        function = database[function_id]
-        meta = function["meta"]
-        if not "metrics" in meta:
-            meta["metrics"] = {}
-
         metric_value = calculate_score(fpath, normalize)
-        meta["metrics"]["cppcheck"] = metric_value
-        function["meta"] = meta
+        store.set(function_id, "cppcheck", metric_value, version)
+    store.flush()
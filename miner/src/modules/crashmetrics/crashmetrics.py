@@ -10,8 +10,11 @@ from fsdict import fsdict
 from easymp import addlogging, parallel, execute
 
 from utils.utils import *
+from utils.scorestore import ScoreStore, scores_path
+from utils.functionindex import load_index
+from modules.crashmetrics.scores import missing_scores
 from modules.crashmetrics.leopard import complexity_metric, vulnerability_metric
-from modules.crashmetrics.codet5p import codet5p_metric
+from modules.crashmetrics.codet5p import codet5p_metric, PRECISIONS, CHECKPOINT_PATH
 from modules.crashmetrics.rats import rats_metric
 from modules.crashmetrics.cppcheck import cppcheck_metric
 from modules.crashmetrics.random import random_metric
@@ -19,13 +22,59 @@ from modules.crashmetrics.recent import recent_changes_metric
 from modules.crashmetrics.sanitizer import sanitizer_metric
 
 
-def run(database, nprocs, progress, function, easymp=True):
+# Version of each metric. Bump a metric's version to recalculate its scores on
+# the next run.
+METRIC_VERSIONS = {
+    "codet5p": 1,
+    "complexity": 1,
+    "vulnerability": 1,
+    "rats": 1,
+    "cppcheck": 1,
+    "recent": 1,
+    "sanitizer": 1,
+    "random": 1,
+}
+
+
+def metric_version(metric, **options):
+    """Version of a metric including the options which change its scores."""
+    version = str(METRIC_VERSIONS[metric])
+    for key, value in sorted(options.items()):
+        version += f",{key}={value}"
+    return version
+
+
+def run(
+    database,
+    scores,
+    nprocs,
+    progress,
+    overwrite,
+    function,
+    metric,
+    version,
+    per_origin=False,
+    easymp=True,
+):
     database = fsdict(database)
-    functions = list(database)
+    store = ScoreStore(scores if scores != None else scores_path(database.abspath))
+    index = load_index(database, progress)
+    functions = index.function_ids()
+    store.add_functions(functions)
+    store.import_meta(database, functions)
+    if not overwrite:
+        functions = missing_scores(store, index, functions, metric, version, per_origin)
+    print(f"[*] Calculate '{metric}' scores for {len(functions)} functions")
+    if len(functions) == 0:
+        return
     shuffle(functions)
-    function_chunks = chunks(functions, chunk_size=1024)
+    function = ft.partial(function, store=store, version=version)
+    if per_origin:
+        # Metrics per origin look up the origins in the index
+        function = ft.partial(function, index=index)
 
     if easymp:
+        function_chunks = chunks(functions, chunk_size=1024)
         execute(
             ft.partial(function, database=database),
             it=function_chunks,
@@ -36,7 +85,8 @@ def run(database, nprocs, progress, function, easymp=True):
             progress_file=sys.stdout,
         )
     else:
-        function(database)
+        function(functions, database)
+    store.flush()
 
 
 @click.group()
@@ -47,8 +97,19 @@ def run(database, nprocs, progress, function, easymp=True):
     required=True,
     help="The function database to work on",
 )
+@click.option(
+    "--scores",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="The score store of the function database (default: <database>.scores)",
+)
 @click.option("--nprocs", type=int, default=1, help="Number of parallel processes")
 @click.option("--progress", is_flag=True, help="Print progress bar (stdout)")
+@click.option(
+    "--overwrite/--no-overwrite",
+    default=False,
+    help="Recalculate scores which are already up to date",
+)
 @click.pass_context
 def cli(ctx, *args, **kwargs):
     ctx.ensure_object(dict)
@@ -59,12 +120,58 @@ def cli(ctx, *args, **kwargs):
 
 
 @cli.command()
+@click.option(
+    "--batch-size",
+    type=int,
+    default=32,
+    help="Maximum number of functions per inference batch",
+)
+@click.option(
+    "--max-tokens-per-batch",
+    type=int,
+    default=8192,
+    help="Maximum number of (padded) tokens per inference batch",
+)
+@click.option(
+    "--precision",
+    type=click.Choice(PRECISIONS),
+    default="fp32",
+    help="Inference precision on CPUs (bf16 autocasting or dynamic int8 quantization)",
+)
+@click.option(
+    "--tolerance",
+    type=float,
+    default=1e-2,
+    help="Maximum score deviation from fp32 to accept a reduced precision",
+)
+@click.option(
+    "--checkpoint",
+    type=click.Path(dir_okay=False),
+    default=CHECKPOINT_PATH,
+    help="Fine-tuned CodeT5+ checkpoint",
+)
+@click.option(
+    "--token-cache",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory of the on-disk token id cache (disabled by default)",
+)
+@click.option(
+    "--threads",
+    type=int,
+    default=None,
+    help="Number of intra-op threads per process (default: #cpus / nprocs)",
+)
 @click.pass_context
 def codet5p(ctx, *args, **kwargs):
+    # The model is sharded across --nprocs processes by the metric itself
+    nprocs = ctx.obj["metrics"]["kwargs"]["nprocs"]
     run(
         *ctx.obj["metrics"]["args"],
         **ctx.obj["metrics"]["kwargs"],
-        function=ft.partial(codet5p_metric, **kwargs),
+        function=ft.partial(codet5p_metric, nprocs=nprocs, **kwargs),
+        metric="codet5p",
+        version=metric_version("codet5p", checkpoint=kwargs["checkpoint"], precision=kwargs["precision"]),
         easymp=False,
     )
 
@@ -75,7 +182,9 @@ def complexity(ctx, *args, **kwargs):
     run(
         *ctx.obj["metrics"]["args"],
         **ctx.obj["metrics"]["kwargs"],
-        function=ft.partial(complexity_metric, **kwargs)
+        function=ft.partial(complexity_metric, **kwargs),
+        metric="complexity",
+        version=metric_version("complexity"),
     )
 
 
@@ -85,7 +194,9 @@ def vulnerability(ctx, *args, **kwargs):
     run(
         *ctx.obj["metrics"]["args"],
         **ctx.obj["metrics"]["kwargs"],
-        function=ft.partial(vulnerability_metric, **kwargs)
+        function=ft.partial(vulnerability_metric, **kwargs),
+        metric="vulnerability",
+        version=metric_version("vulnerability"),
     )
 
 
@@ -95,17 +206,14 @@ def vulnerability(ctx, *args, **kwargs):
     default=True,
     help="Normalize the severity for the number of lines of each function",
 )
-@click.option(
-    "--overwrite/--no-overwrite",
-    default=False,
-    help="Overwrite scores which have already been calculated",
-)
 @click.pass_context
 def rats(ctx, *args, **kwargs):
     run(
         *ctx.obj["metrics"]["args"],
         **ctx.obj["metrics"]["kwargs"],
-        function=ft.partial(rats_metric, **kwargs)
+        function=ft.partial(rats_metric, **kwargs),
+        metric="rats",
+        version=metric_version("rats", **kwargs),
     )
 
 
@@ -120,7 +228,9 @@ def cppcheck(ctx, *args, **kwargs):
     run(
         *ctx.obj["metrics"]["args"],
         **ctx.obj["metrics"]["kwargs"],
-        function=ft.partial(cppcheck_metric, **kwargs)
+        function=ft.partial(cppcheck_metric, **kwargs),
+        metric="cppcheck",
+        version=metric_version("cppcheck", **kwargs),
     )
 
 
@@ -137,7 +247,10 @@ def recent_changes(ctx, *args, **kwargs):
         *ctx.obj["metrics"]["args"],
         **ctx.obj["metrics"]["kwargs"],
         function=ft.partial(recent_changes_metric, **kwargs),
-        easymp=False
+        metric="recent",
+        version=metric_version("recent"),
+        per_origin=True,
+        easymp=False,
     )
 
 
@@ -148,13 +261,28 @@ def recent_changes(ctx, *args, **kwargs):
     type=click.Path(exists=True, file_okay=False),
     help="The crash database.",
 )
+@click.option(
+    "--backend",
+    type=click.Choice(["objdump", "elf"]),
+    default="objdump",
+    help="Count the sanitizer calls in the output of objdump or by decoding the binary with capstone.",
+)
+@click.option(
+    "--cache",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory of the on-disk cache of sanitizer scores per fuzzer binary (disabled by default)",
+)
 @click.pass_context
 def sanitizers(ctx, *args, **kwargs):
     run(
         *ctx.obj["metrics"]["args"],
         **ctx.obj["metrics"]["kwargs"],
         function=ft.partial(sanitizer_metric, **kwargs),
-        easymp=False
+        metric="sanitizer",
+        version=metric_version("sanitizer", backend=kwargs["backend"]),
+        per_origin=True,
+        easymp=False,
     )
 
 
@@ -167,7 +295,9 @@ def random(ctx, *args, **kwargs):
     run(
         *ctx.obj["metrics"]["args"],
         **ctx.obj["metrics"]["kwargs"],
-        function=ft.partial(random_metric, **kwargs)
+        function=ft.partial(random_metric, **kwargs),
+        metric="random",
+        version=metric_version("random", **kwargs),
     )
 
 
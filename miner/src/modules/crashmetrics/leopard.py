@@ -3,32 +3,30 @@ from mcpp.config import TreeSitterConfig, Config
 from mcpp.__main__ import run
 from fsdict import fsdict
 from config import PARSER_LIB
+from utils.utils import with_tempdir
+from utils.sourcestore import FunctionSources
 
 
-def complexity_metric(function_ids, database):
+@with_tempdir
+def complexity_metric(directory, function_ids, database, store, version):
     treesitter = TreeSitterConfig(Path(PARSER_LIB), None)
+    sources = FunctionSources(database)
     complexity_metrics = ["C1", "C2", "C3", "C4"]
 
     for function_id in function_ids:
-        function = database[function_id]
-        meta = function["meta"]
-        source_path = function.abspath / "source"
+        source_path = sources.fpath(function_id, directory)
         config = Config(source_path, None, complexity_metrics, None, treesitter)
         scores = run(config)
         score = sum(scores[str(source_path)][cm] for cm in complexity_metrics)
 
-        if not "metrics" in meta:
-            meta["metrics"] = {}
-        metrics = meta["metrics"]
+        store.set(function_id, "complexity", score, version)
+    store.flush()
 
-        if not "complexity" in metrics:
-            metrics["complexity"] = score
-            meta["metrics"] = metrics
-            function["meta"] = meta
 
-
-def vulnerability_metric(function_ids, database):
+@with_tempdir
+def vulnerability_metric(directory, function_ids, database, store, version):
     treesitter = TreeSitterConfig(Path(PARSER_LIB), None)
+    sources = FunctionSources(database)
     vulnerability_metrics = [
         "V1",
         "V2",
@@ -43,18 +41,10 @@ def vulnerability_metric(function_ids, database):
         "V11",
     ]
     for function_id in function_ids:
-        function = database[function_id]
-        meta = function["meta"]
-        source_path = function.abspath / "source"
+        source_path = sources.fpath(function_id, directory)
         config = Config(source_path, None, vulnerability_metrics, None, treesitter)
         scores = run(config)
         score = sum(scores[str(source_path)][cm] for cm in vulnerability_metrics)
 
-        if not "metrics" in meta:
-            meta["metrics"] = {}
-        metrics = meta["metrics"]
-
-        if not "vulnerability" in metrics:
-            metrics["vulnerability"] = score
-            meta["metrics"] = metrics
-            function["meta"] = meta
+        store.set(function_id, "vulnerability", score, version)
+    store.flush()
@@ -1,35 +1,48 @@
 """ Set a default score (-1) to functions without scores.
 """
 import click
+import numpy as np
 from tqdm import tqdm
 
 from fsdict import fsdict
+from utils.scorestore import ScoreStore, scores_path
+from utils.functionindex import load_index
 
 
-def run(database):
-    database = fsdict(database)
-
-    # Find all utilized metrics
-    used_metrics = set()
-
-    for function in tqdm(database.values(), total=len(database)):
+def export_metrics(database, store, function_ids):
+    """Merge the scores of the store into the meta of each function. Scores of
+    metrics which are not in the store are kept.
+    """
+    metrics = {metric: store.scores(metric) for metric in store.metrics()}
+    for function_id in tqdm(function_ids, desc="Export scores"):
+        function = database[function_id]
         meta = function["meta"]
-        metrics = meta["metrics"]
+        row = store.row(function_id)
+        meta_metrics = dict(meta.get("metrics", {}))
+        meta_metrics.update(
+            (metric, float(scores[row]))
+            for metric, scores in metrics.items()
+            if not np.isnan(scores[row])
+        )
+        meta["metrics"] = meta_metrics
+        function["meta"] = meta
 
-        for metric in metrics:
-            used_metrics.add(metric)
 
-    # Set default scores to missing function scores
-    for function in tqdm(database.values(), total=len(database)):
-        meta = function["meta"]
-        metrics = meta["metrics"]
+def run(database, scores, export):
+    database = fsdict(database)
+    store = ScoreStore(scores if scores != None else scores_path(database.abspath))
+    function_ids = load_index(database).function_ids()
+    store.add_functions(function_ids)
+    store.import_meta(database, function_ids)
 
-        for metric in used_metrics:
-            if not metric in metrics:
-                metrics[metric] = -1
+    # Set default scores to missing function scores of all utilized metrics
+    for metric in store.metrics():
+        metric_scores = store.scores(metric)
+        metric_scores[np.isnan(metric_scores)] = -1
+    store.flush()
 
-        meta["metrics"] = metrics
-        function["meta"] = meta
+    if export:
+        export_metrics(database, store, function_ids)
 
 
 @click.command()
@@ -40,8 +53,19 @@ def run(database):
     required=True,
     help="The function database to work on",
 )
-def cli(database):
-    run(database)
+@click.option(
+    "--scores",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="The score store of the function database (default: <database>.scores)",
+)
+@click.option(
+    "--export/--no-export",
+    default=False,
+    help="Also write the scores to the meta of each function",
+)
+def cli(database, scores, export):
+    run(database, scores, export)
 
 
 if __name__ == "__main__":
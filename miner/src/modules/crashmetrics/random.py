@@ -2,13 +2,9 @@ import random
 from fsdict import fsdict
 
 
-def random_metric(function_ids, database, seed):
+def random_metric(function_ids, database, store, seed, version):
     for function_id in function_ids:
-        function = database[function_id]
-        meta = function["meta"]
-        if not "metrics" in meta:
-            meta["metrics"] = {}
-
         random.seed(int(function_id, 16) + seed)
-        meta["metrics"]["random"] = random.randint(0, int(1e9)) / 1e9
-        function["meta"] = meta
+        score = random.randint(0, int(1e9)) / 1e9
+        store.set(function_id, "random", score, version)
+    store.flush()
@@ -1,8 +1,8 @@
 import re
 from fsdict import fsdict
 from pathlib import Path
-from shutil import copy
 from utils.utils import *
+from utils.sourcestore import FunctionSources
 
 
 def calculate_score(fpath, normalize):
@@ -24,7 +24,7 @@ def calculate_score(fpath, normalize):
 
 
 @with_tempdir
-def rats_metric(directory, function_ids, database, normalize, overwrite):
+def rats_metric(directory, function_ids, database, store, normalize, version):
     directory = Path(directory)
     in_dir = directory / "in"
     out_dir = directory / "out"
@@ -32,12 +32,9 @@ def rats_metric(directory, function_ids, database, normalize, overwrite):
     in_dir.mkdir()
     out_dir.mkdir()
 
+    sources = FunctionSources(database)
     for idx, function_id in enumerate(function_ids):
-        meta = database[function_id]["meta"]
-        if "metrics" in meta and "rats" in meta["metrics"] and not overwrite:
-            continue
-        fpath = database[function_id].abspath / "source"
-        copy(fpath, in_dir / f"{idx}.c")
+        sources.write(function_id, in_dir / f"{idx}.c")
 
     cmd = [
         "docker",
@@ -53,13 +50,6 @@ def rats_metric(directory, function_ids, database, normalize, overwrite):
 
     for idx, function_id in enumerate(function_ids):
         fpath = out_dir / str(idx)
-        function = database[function_id]
-        meta = function["meta"]
-        if "metrics" in meta and "rats" in meta["metrics"] and not overwrite:
-            continue
-        if not "metrics" in meta:
-            meta["metrics"] = {}
-
         metric_value = calculate_score(fpath, normalize)
-        meta["metrics"]["rats"] = metric_value
-        function["meta"] = meta
+        store.set(function_id, "rats", metric_value, version)
+    store.flush()
@@ -10,6 +10,8 @@ from typing import List
 from utils.utils import *
 from fsdict import fsdict
 from config import TEMPDIR, C_EXTENSIONS, CPP_EXTENSIONS
+from modules.crashmetrics.scores import score_stamp
+from utils.pathmatcher import PathMatcher
 
 
 @dataclass
@@ -18,13 +20,6 @@ class Bundle:
     crashes: List[int]
 
 
-def get_first_mismatch(it1, it2):
-    for idx, (el1, el2) in enumerate(zip(it1, it2)):
-        if el1 != el2:
-            return idx
-    return min(len(it1), len(it2))
-
-
 def get_timestamps(source_file, git_directory):
     cmd = f"git blame -t {source_file}" 
     res = do_run(cmd.split(" "), cwd=str(git_directory))
@@ -78,6 +73,8 @@ def recent_changes(git_directory, crash, functions_by_local_id):
         if any(str_path.lower().endswith(f".{ext}") for ext in CPP_EXTENSIONS):
             source_files.append(str_path)
 
+    matcher = PathMatcher(source_files)
+
     scores = []
     git_blame_cache = {}
     for function_id, origin in functions_by_local_id[local_id]:
@@ -85,16 +82,13 @@ def recent_changes(git_directory, crash, functions_by_local_id):
         start = origin["start"]
         end = origin["end"]
 
-        # Find best matching source file
-        scored_files = [
-            (source_file, get_first_mismatch(fpath[::-1], source_file[::-1]))
-            for source_file in source_files
-        ]
-        source_file, first_mismatch = max(scored_files, key=lambda el: el[1])
-
-        # Sanity check: at least the filename should match
-        if Path(fpath).name != Path(source_file).name:
+        # Find the best matching source file, i.e., the one whose full path
+        # shares the longest suffix with the path of the function. Sanity
+        # check: at least the filename should match.
+        idx = matcher.match(fpath)
+        if idx == None:
             continue
+        source_file = source_files[idx]
 
         # Find all changes within this range
         # Create the timestamps first if they are not already in the cache
@@ -155,7 +149,10 @@ def recent_changes_metric_project(bundle, crash_database, functions_by_local_id)
     return scores
 
 
-def create_scores_in_parallel(bundles, database, crash_database, functions_by_local_id, nprocs):
+def create_scores_in_parallel(bundles, index, store, crash_database, functions_by_local_id, nprocs, version):
+    # Scores of this run replace stale scores of previous runs
+    updated = set()
+
     with mp.Pool(nprocs) as p:
         scores_it = p.imap_unordered(
                 ft.partial(recent_changes_metric_project, crash_database=crash_database, functions_by_local_id=functions_by_local_id),
@@ -163,18 +160,14 @@ def create_scores_in_parallel(bundles, database, crash_database, functions_by_lo
         )
         for score_list in tqdm(scores_it, total=len(bundles)):
             for function_id, score in score_list:
-                meta = database[function_id]["meta"]
-
-                if not "metrics" in meta:
-                    meta["metrics"] = {}
+                if function_id in updated:
+                    score = max(score, store.get(function_id, "recent"))
+                updated.add(function_id)
 
-                metrics = meta["metrics"]
+                stamp = score_stamp(version, index.origin_count(function_id))
+                store.set(function_id, "recent", score, stamp)
 
-                if not "recent" in metrics or metrics["recent"] < score:
-                    metrics["recent"] = score
-
-                meta["metrics"] = metrics
-                database[function_id]["meta"] = meta
+    return updated
 
 
 def create_bundles(crash_database, functions_by_local_id, max_bundle_size):
@@ -200,28 +193,13 @@ def create_bundles(crash_database, functions_by_local_id, max_bundle_size):
     return bundles
 
 
-def recent_changes_metric(database, crash_database):
+def recent_changes_metric(function_ids, database, store, index, crash_database, version):
     crash_database = fsdict(crash_database)
 
-    # Load all function meta into RAM
-    print("[*] Create function list")
-    functions = {
-        function_id: function["meta"] for function_id, function in tqdm(database.items(), total=len(database))
-    }
-
     with mp.Manager() as manager:
         # Map code all function locations to local ids
         print("[*] Create crash to functions mapping")
-        functions_by_local_id = {}
-
-        for function_id, meta in tqdm(functions.items(), total=len(functions)):
-            for origin in meta["origins"]:
-                local_id = int(origin["crash"])
-
-                if not local_id in functions_by_local_id:
-                    functions_by_local_id[local_id] = []
-
-                functions_by_local_id[local_id].append((function_id, origin))
+        functions_by_local_id = index.origins_by_crash(function_ids)
 
         functions_by_local_id = manager.dict(functions_by_local_id)
 
@@ -238,4 +216,11 @@ def recent_changes_metric(database, crash_database):
         random.shuffle(bundles)
         bundles = sorted(bundles, key=lambda bundle: len(bundle.crashes), reverse=True)
 
-        create_scores_in_parallel(bundles, database, crash_database, functions_by_local_id, nprocs)
+        updated = create_scores_in_parallel(bundles, index, store, crash_database, functions_by_local_id, nprocs, version)
+
+        # Stamp functions without any score with the default score -1 (see
+        # missingscores), so that they are not retried on every run.
+        for function_id in function_ids:
+            if not function_id in updated:
+                store.set(function_id, "recent", -1, score_stamp(version, index.origin_count(function_id)))
+        store.flush()
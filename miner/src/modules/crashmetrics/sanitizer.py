@@ -1,20 +1,30 @@
 import os
 import sys
 import random
-import io
 import re
+import struct
 import subprocess
 import posixpath
 import multiprocessing as mp
 import functools as ft
+from bisect import bisect_left, bisect_right
 from pathlib import Path
 from dataclasses import dataclass
-from typing import List
+from typing import Dict, List
 from elftools.elf.elffile import ELFFile
+
+try:
+    import capstone
+except ImportError:
+    capstone = None
+
 from fsdict import fsdict
 from tqdm import tqdm
 
 from utils.modules import fuzzer_exists, get_fuzzer
+from modules.crashmetrics.scores import score_stamp
+from utils.sanitizercache import SanitizerCache
+from utils.pathmatcher import PathMatcher
 
 
 @dataclass
@@ -23,10 +33,28 @@ class Bundle:
     crashes: List[int]
 
 
+# Substrings of the instructions which call into the sanitizers' runtimes
+SANITIZER_PATTERNS = {"asan": "__asan", "ubsan": "__ubsan", "msan": "__msan"}
+
+FUNCTION_HEADER = re.compile("^[0-9a-fA-F]+ <(.*)>:$")
+
+# Instructions and operands of capstone's disassembly
+BRANCH_MNEMONICS = ("j", "call", "loop")
+BRANCH_TARGET = re.compile("^0x[0-9a-f]+$")
+RIP_OPERAND = re.compile(r"\[rip ([+-]) (0x[0-9a-f]+)\]")
+
+# objdump prints at most 7 instruction bytes per line on x86. It replaces runs
+# of at least 8 zero bytes with "..." and, at the end of a function, runs of
+# less than 3.
+OBJDUMP_BYTES_PER_LINE = 7
+OBJDUMP_SKIP_ZEROES = 8
+OBJDUMP_SKIP_ZEROES_AT_END = 3
+
+
 @dataclass
 class Function:
     mangled_name: str
-    instructions: List[str]
+    scores: Dict[str, int]
     low_pc: int
     high_pc: int
     name: str = ""
@@ -114,61 +142,6 @@ def lpe_filename(line_program, file_index):
 #                yield source_file, function_name
 
 
-def skip_whitespace_lines(f):
-    while True:
-        start = f.tell()
-        line = f.readline()
-        if len(line) == 0:
-            raise RuntimeError()
-
-        if len(line.strip()) > 0:
-            f.seek(start)
-            return
-
-
-def is_function_separator(f):
-    start = f.tell()
-
-    next_line = f.readline()
-    if len(next_line) == 0:
-        raise RuntimeError()
-
-    if next_line == "\n":
-        f.seek(start)
-        return True
-
-    f.seek(start)
-    return False
-
-
-def is_next_section(f):
-    start = f.tell()
-
-    next_line = f.readline()
-    if len(next_line) == 0:
-        raise RuntimeError()
-
-    if next_line.startswith("Disassembly of section"):
-        f.seek(start)
-        return True
-
-    f.seek(start)
-    return False
-
-
-def parse_function_header(f):
-    line = f.readline().strip()
-    match = re.match("^[0-9a-fA-F]+ <(.*)>:$", line)
-    assert match is not None
-
-    return match.group(1)
-
-
-def parse_function_instructions(f):
-    while not is_function_separator(f):
-        instruction_line = f.readline()
-        yield instruction_line
-
 def get_addr_of_instr(instr):
     addr_str = instr.strip().split(":")[0]
     try:
@@ -177,58 +150,310 @@ def get_addr_of_instr(instr):
         return None
     return addr
 
-def parse_function(f):
-    mangled_name = parse_function_header(f)
-    instructions = list(parse_function_instructions(f))
-    skip_whitespace_lines(f)
 
-    low_pc = get_addr_of_instr(instructions[0])
-    high_pc = get_addr_of_instr(instructions[-1])
+def count_sanitizer_calls(instruction, counts):
+    instruction = instruction.lower()
+    for sanitizer, pattern in SANITIZER_PATTERNS.items():
+        if pattern in instruction:
+            counts[sanitizer] += 1
 
-    if low_pc == None or high_pc == None:
-        return None
 
-    return Function(mangled_name=mangled_name, instructions=instructions, low_pc=low_pc, high_pc=high_pc)
+def make_function(mangled_name, first_instruction, last_instruction, counts):
+    if first_instruction == None:
+        return None
 
+    low_pc = get_addr_of_instr(first_instruction)
+    high_pc = get_addr_of_instr(last_instruction)
 
-def parse_section(f):
-    while not is_next_section(f):
-        function = parse_function(f)
-        if function != None:
-            yield function
+    if low_pc == None or high_pc == None:
+        return None
 
+    return Function(mangled_name=mangled_name, scores=counts, low_pc=low_pc, high_pc=high_pc)
 
-def parse_objdump(f):
-    while True:
-        line = f.readline()
-        if len(line) == 0:
-            raise RuntimeError()
 
+def parse_objdump(lines):
+    """Parse the functions of the .text section from the lines of objdump's
+    output. Only the sanitizer calls of the instructions are counted, the
+    instructions themselves are not kept.
+    """
+    lines = iter(lines)
+    for line in lines:
         if "Disassembly of section .text:" in line:
             break
 
-    skip_whitespace_lines(f)
-    yield from parse_section(f)
+    mangled_name = None
+    for line in lines:
+        if mangled_name == None:
+            # Function header or the next section
+            if len(line.strip()) == 0:
+                continue
+            if line.startswith("Disassembly of section"):
+                return
+            match = FUNCTION_HEADER.match(line.strip())
+            assert match is not None
+            mangled_name = match.group(1)
+            first_instruction = None
+            last_instruction = None
+            counts = {sanitizer: 0 for sanitizer in SANITIZER_PATTERNS}
+            continue
+
+        if line == "\n":
+            # End of the function
+            function = make_function(mangled_name, first_instruction, last_instruction, counts)
+            if function != None:
+                yield function
+            mangled_name = None
+            continue
+
+        if first_instruction == None:
+            first_instruction = line
+        last_instruction = line
+        count_sanitizer_calls(line, counts)
+
+    # The last function is not followed by an empty line
+    if mangled_name != None:
+        function = make_function(mangled_name, first_instruction, last_instruction, counts)
+        if function != None:
+            yield function
 
 
 def process_objdump(filename):
-    p = subprocess.run(
-        ["objdump", "-D", "-M", "intel", filename], stdout=subprocess.PIPE
+    """Stream the functions of the .text section of a binary from objdump."""
+    p = subprocess.Popen(
+        ["objdump", "-d", "-j", ".text", "-M", "intel", filename],
+        stdout=subprocess.PIPE,
+        encoding="utf-8",
     )
-    p.check_returncode()
+    try:
+        yield from parse_objdump(p.stdout)
+    finally:
+        p.stdout.close()
+        returncode = p.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, p.args)
+
+
+def iter_symbol_relocations(elffile, section):
+    """(offset, symbol index) of the relocations of a section which refer to a
+    symbol. Most relocations of a shared object are relative ones without a
+    symbol, so those of x86-64 objects are unpacked in bulk.
+    """
+    if elffile.elfclass == 64 and elffile.little_endian and section["sh_type"] == "SHT_RELA":
+        for offset, info, _ in struct.iter_unpack("<QQq", section.data()):
+            if info >> 32 != 0:
+                yield offset, info >> 32
+        return
+    for relocation in section.iter_relocations():
+        if relocation["r_info_sym"] != 0:
+            yield relocation["r_offset"], relocation["r_info_sym"]
+
+
+def symbol_versions(elffile):
+    """Version suffixes of the defined dynamic symbols by their index, e.g.,
+    @@GLIBC_2.2.5 for the default and @GLIBC_2.2.5 for a hidden version.
+    """
+    versym = elffile.get_section_by_name(".gnu.version")
+    if versym == None:
+        return {}
+    names = {}
+    verdef = elffile.get_section_by_name(".gnu.version_d")
+    if verdef != None:
+        for version, auxiliaries in verdef.iter_versions():
+            names[version["vd_ndx"]] = next(iter(auxiliaries)).name
+
+    versions = {}
+    for index in range(versym.num_symbols()):
+        ndx = versym.get_symbol(index)["ndx"]
+        if ndx == "VER_NDX_GLOBAL":
+            versions[index] = "@@Base"
+        elif isinstance(ndx, int) and ndx & 0x7FFF in names:
+            separator = "@" if ndx & 0x8000 else "@@"
+            versions[index] = separator + names[ndx & 0x7FFF]
+    return versions
+
+
+class SymbolTable:
+    """Symbols of a binary by address, along with the synthetic symbols
+    objdump shows for PLT entries (<name>@plt) and relocated GOT slots
+    (<name>@Base).
+    """
+
+    def __init__(self, elffile, disassembler):
+        symtab = elffile.get_section_by_name(".symtab")
+        versions = {}
+        if symtab == None:
+            symtab = elffile.get_section_by_name(".dynsym")
+            versions = symbol_versions(elffile)
+
+        # Of the symbols at the same address, objdump shows functions before
+        # other symbols, global before weak before local symbols, larger
+        # before smaller symbols and otherwise sorts them by name
+        symbols = {}
+        for index, symbol in enumerate(symtab.iter_symbols() if symtab != None else []):
+            if len(symbol.name) == 0:
+                continue
+            if symbol["st_info"]["type"] in ["STT_FILE", "STT_SECTION"]:
+                continue
+            if symbol["st_shndx"] in ["SHN_UNDEF", "SHN_ABS", "SHN_COMMON"]:
+                continue
+            address = symbol["st_value"]
+            rank = (
+                not symbol["st_info"]["type"] in ["STT_FUNC", "STT_GNU_IFUNC"],
+                symbol["st_info"]["bind"] == "STB_LOCAL",
+                symbol["st_info"]["bind"] != "STB_GLOBAL",
+                -symbol["st_size"],
+                symbol.name.startswith("."),
+                symbol.name.encode("utf-8"),
+            )
+            if not address in symbols or rank < symbols[address][0]:
+                name = symbol.name + versions.get(index, "")
+                symbols[address] = (rank, name, symbol["st_shndx"])
+        self.addresses = sorted(symbols)
+        self.names = [symbols[address][1] for address in self.addresses]
+        self.sections = [symbols[address][2] for address in self.addresses]
+
+        # Relocated GOT slots
+        got_names = {}
+        for section in elffile.iter_sections():
+            if section["sh_type"] not in ["SHT_RELA", "SHT_REL"] or section["sh_link"] == 0:
+                continue
+            relocation_symtab = elffile.get_section(section["sh_link"])
+            for offset, symbol_index in iter_symbol_relocations(elffile, section):
+                name = relocation_symtab.get_symbol(symbol_index).name
+                if len(name) > 0:
+                    got_names[offset] = name
+        self.synthetic = {address: f"{name}@Base" for address, name in got_names.items()}
+
+        # PLT entries jump to the address in their GOT slot
+        for section_name in [".plt", ".plt.sec", ".plt.got"]:
+            section = elffile.get_section_by_name(section_name)
+            if section == None:
+                continue
+            section_address = section["sh_addr"]
+            entry_size = section["sh_entsize"] or 16
+            instructions = disassembler.disasm_lite(section.data(), section_address)
+            for address, size, mnemonic, op_str in instructions:
+                target = rip_relative_address(address, size, op_str)
+                if not "jmp" in mnemonic or not target in got_names:
+                    continue
+                entry = section_address + (address - section_address) // entry_size * entry_size
+                if not entry in self.synthetic:
+                    self.synthetic[entry] = f"{got_names[target]}@plt"
+
+    def resolve(self, address):
+        """Name of the symbol objdump shows for an address or None."""
+        if address in self.synthetic:
+            return self.synthetic[address]
+        idx = bisect_right(self.addresses, address) - 1
+        if idx < 0:
+            return None
+        return self.names[idx]
+
+    def functions(self, elffile, section_name):
+        """(name, start, end) of the symbols of a section. Like objdump, the
+        range of a symbol ends at the next symbol.
+        """
+        section_index = next(
+            idx
+            for idx, section in enumerate(elffile.iter_sections())
+            if section.name == section_name
+        )
+        section = elffile.get_section(section_index)
+        section_end = section["sh_addr"] + section["sh_size"]
+        starts = [
+            (address, name)
+            for address, name, shndx in zip(self.addresses, self.names, self.sections)
+            if shndx == section_index and address < section_end
+        ]
+        # objdump names code before the first symbol relative to it
+        if len(starts) > 0 and starts[0][0] > section["sh_addr"]:
+            address, name = starts[0]
+            starts.insert(0, (section["sh_addr"], f"{name}-{address - section['sh_addr']:#x}"))
+        for idx, (address, name) in enumerate(starts):
+            end = starts[idx + 1][0] if idx + 1 < len(starts) else section_end
+            yield name, address, end
+
+
+def rip_relative_address(address, size, op_str):
+    match = RIP_OPERAND.search(op_str)
+    if match == None:
+        return None
+    displacement = int(match.group(2), base=16)
+    if match.group(1) == "-":
+        displacement = -displacement
+    return address + size + displacement
+
+
+def iter_instructions(disassembler, code, address):
+    """Decode the instructions of a function and skip its runs of zeros like
+    objdump, which prints them as "..." without an address.
+    """
+    offset = 0
+    while offset < len(code):
+        skip = None
+        for instruction in disassembler.disasm_lite(code[offset:], address + offset):
+            offset = instruction[0] - address
+            zeros = len(code) - offset - len(code[offset:].lstrip(b"\0")) if code[offset] == 0 else 0
+            at_end = offset + zeros == len(code)
+            if zeros >= OBJDUMP_SKIP_ZEROES or (at_end and 0 < zeros < OBJDUMP_SKIP_ZEROES_AT_END):
+                # Zeros followed by code are skipped in multiples of 4
+                skip = zeros if at_end else zeros & ~3
+                break
+            yield instruction
+            offset += instruction[1]
+        if skip == None:
+            break
+        offset += skip
 
-    content = io.StringIO(p.stdout.decode("utf-8"))
-    yield from parse_objdump(content)
 
+def process_elf(filename):
+    """Count the sanitizer calls of the functions of the .text section without
+    a text disassembly. Instructions are decoded with capstone and their
+    branch targets and rip-relative operands are resolved against the symbol
+    table, like the symbols objdump shows in its disassembly.
+    """
+    if capstone == None:
+        raise RuntimeError("The elf backend requires capstone (pip install capstone)")
 
-def function_score(instructions):
-    sanitizer_patterns = {"asan": "__asan", "ubsan": "__ubsan", "msan": "__msan"}
-    sanitizer_count = {key: 0 for key in sanitizer_patterns}
-    for instruction in instructions:
-        for sanitizer, pattern in sanitizer_patterns.items():
-            if pattern in instruction.lower():
-                sanitizer_count[sanitizer] += 1
-    return sanitizer_count
+    disassembler = capstone.Cs(capstone.CS_ARCH_X86, capstone.CS_MODE_64)
+    disassembler.skipdata = True
+
+    with open(filename, "rb") as f:
+        elffile = ELFFile(f)
+        symbols = SymbolTable(elffile, disassembler)
+        text = elffile.get_section_by_name(".text")
+        if text == None:
+            return
+        data = text.data()
+        text_address = text["sh_addr"]
+
+        for mangled_name, start, end in symbols.functions(elffile, ".text"):
+            code = data[start - text_address : end - text_address]
+            counts = {sanitizer: 0 for sanitizer in SANITIZER_PATTERNS}
+            low_pc = None
+            for address, size, mnemonic, op_str in iter_instructions(disassembler, code, start):
+                if low_pc == None:
+                    low_pc = address
+                # objdump continues long instructions on further lines
+                high_pc = address + (size - 1) // OBJDUMP_BYTES_PER_LINE * OBJDUMP_BYTES_PER_LINE
+
+                # Strip prefixes such as "bnd" or "notrack"
+                if BRANCH_TARGET.match(op_str) and mnemonic.split(" ")[-1].startswith(BRANCH_MNEMONICS):
+                    target = int(op_str, base=16)
+                else:
+                    target = rip_relative_address(address, size, op_str)
+                if target == None:
+                    continue
+                name = symbols.resolve(target)
+                if name != None:
+                    count_sanitizer_calls(name, counts)
+
+            if low_pc != None:
+                yield Function(mangled_name=mangled_name, scores=counts, low_pc=low_pc, high_pc=high_pc)
+
+
+# Functions of a binary along with their sanitizer calls by backend
+BACKENDS = {"objdump": process_objdump, "elf": process_elf}
 
 
 def augment_with_demangled_name(functions):
@@ -239,28 +464,53 @@ def augment_with_demangled_name(functions):
     return functions
 
 
+class AddressIndex:
+    """Functions sorted by the start of their address range."""
+
+    def __init__(self, functions):
+        self.functions = sorted(functions, key=lambda function: function.low_pc)
+        self.low_pcs = [function.low_pc for function in self.functions]
+
+    def find(self, address):
+        """The functions whose address range contains the address."""
+        idx = bisect_right(self.low_pcs, address)
+        if idx == 0:
+            return []
+        # Functions might share their start address
+        low_pc = self.low_pcs[idx - 1]
+        lo = bisect_left(self.low_pcs, low_pc, hi=idx)
+        return [
+            function
+            for function in self.functions[lo:idx]
+            if address <= function.high_pc
+        ]
+
+
 def augment_with_dwarf_info(filename, functions):
-    function_origins = {}
+    """Set the file name and line of each function to the ones of the first
+    line program entry within its address range.
+    """
+    index = AddressIndex(functions)
 
     with open(filename, "rb") as f:
         elffile = ELFFile(f)
 
         if not elffile.has_dwarf_info():
-            return
+            return []
 
         dwarf_info = elffile.get_dwarf_info()
 
         for CU in dwarf_info.iter_CUs():
             line_program = dwarf_info.line_program_for_CU(CU)
             for entry in line_program.get_entries():
-                if entry.state:
-                    for function in functions:
-                        low_pc = function.low_pc
-                        high_pc = function.high_pc
-                        if low_pc <= entry.state.address <= high_pc:
-                            function.file_name = lpe_filename(line_program, entry.state.file)
-                            function.line = entry.state.line
-                            yield function
+                if not entry.state:
+                    continue
+                for function in index.find(entry.state.address):
+                    if function.line < 0:
+                        function.file_name = lpe_filename(line_program, entry.state.file)
+                        function.line = entry.state.line
+
+    return functions
 
 
 def get_extension(file_name):
@@ -269,8 +519,8 @@ def get_extension(file_name):
     return file_name.split(".")[-1].lower()
 
 
-def sanitizer_scores_file(elf_path):
-    functions = list(process_objdump(elf_path))
+def sanitizer_scores_file(elf_path, backend="objdump"):
+    functions = list(BACKENDS[backend](elf_path))
     functions = augment_with_demangled_name(functions)
     functions = augment_with_dwarf_info(elf_path, functions)
     dwarf_functions = {}
@@ -292,19 +542,22 @@ def sanitizer_scores_file(elf_path):
 
     scores = []
     for function in dwarf_functions.values():
-        score = function_score(function.instructions)
-        scores.append((function.name, function.file_name, function.line, score))
+        scores.append((function.name, function.file_name, function.line, function.scores))
     return scores
 
 
-def get_first_mismatch(it1, it2):
-    for idx, (el1, el2) in enumerate(zip(it1, it2)):
-        if el1 != el2:
-            return idx
-    return min(len(it1), len(it2))
+def cached_sanitizer_scores_file(elf_path, backend="objdump", cache=None):
+    if cache == None:
+        return sanitizer_scores_file(elf_path, backend)
+    key = cache.key(elf_path, backend)
+    scores = cache.get(key)
+    if scores == None:
+        scores = sanitizer_scores_file(elf_path, backend)
+        cache.set(key, scores)
+    return scores
 
 
-def sanitizer_scores_crash(crash, functions_by_local_id):
+def sanitizer_scores_crash(crash, functions_by_local_id, backend="objdump", cache=None):
     scores = []
     meta = crash["meta"]
     project_name = meta["project"]
@@ -333,54 +586,49 @@ def sanitizer_scores_crash(crash, functions_by_local_id):
         return scores
     fuzzer = get_fuzzer(crash, target, engine, sanitizer, instrumentation, commit)
     fuzzer_path = fuzzer.abspath / "out" / target
-    raw_scores = sanitizer_scores_file(str(fuzzer_path))
+    raw_scores = cached_sanitizer_scores_file(str(fuzzer_path), backend, cache)
     if len(raw_scores) == 0:
         return scores
 
+    # Index the source files of the functions of the binary
+    matcher = PathMatcher(source_file for _, source_file, _, _ in raw_scores)
+
     for function_id, origin in functions_by_local_id[local_id]:
         fpath = origin["fpath"]
         origin_name = origin["name"]
         origin_line = origin["start"]
         MAX_LINE_DISTANCE = 5
 
-        # Find best matching source file
-        scored_files = []
-        for name, source_file, line, san_scores in raw_scores:
+        def accept(idx):
+            name, source_file, line, san_scores = raw_scores[idx]
             # We perform the matching via names and line number. If there are
             # names missing, we can't perform the matching.
             if len(name) == 0 or len(origin_name) == 0:
-                continue
+                return False
 
             # Either function name should contain the other We don't test for
             # equal names as one might be fully qualified with namespaces and
             # the other without. Or template brackets and the others without.
             # Or what else C++ might throw at us.
             if not (name in origin_name or origin_name in name):
-                continue
+                return False
 
             # Make sure at least the file names match.
-            if Path(fpath).name != Path(source_file).name:
-                continue
-
-            # Calculate a score measuring how well the full file paths match.
-            first_mismatch = get_first_mismatch(fpath[::-1], source_file[::-1])
-
-            scored_files.append((san_scores, first_mismatch))
+            return Path(fpath).name == Path(source_file).name
 
-
-        if len(scored_files) == 0:
+        # Find the best matching source file, i.e., the one whose full path
+        # shares the longest suffix with the path of the function
+        idx = matcher.match(fpath, accept)
+        if idx == None:
             continue
 
-        sanitizer_scores, _ = max(
-            scored_files, key=lambda el: el[1]
-        )
-
+        _, _, _, sanitizer_scores = raw_scores[idx]
         scores.append((function_id, sanitizer_scores))
 
     return scores
 
 
-def sanitizer_scores_project(bundle, crash_database, functions_by_local_id):
+def sanitizer_scores_project(bundle, crash_database, functions_by_local_id, backend="objdump", cache=None):
     project_name = bundle.name
     project = crash_database[project_name]
     scores = []
@@ -391,38 +639,41 @@ def sanitizer_scores_project(bundle, crash_database, functions_by_local_id):
     # Collect reproduced crashes for the project
     for local_id in bundle.crashes:
         crash = project["crashes"][str(local_id)]
-        scores += sanitizer_scores_crash(crash, functions_by_local_id)
+        scores += sanitizer_scores_crash(crash, functions_by_local_id, backend, cache)
 
     return scores
 
 
-def create_scores_in_parallel(bundles, database, crash_database, functions_by_local_id, nprocs):
+def create_scores_in_parallel(bundles, index, store, crash_database, functions_by_local_id, nprocs, version, backend="objdump", cache=None):
+    # Scores of this run replace stale scores of previous runs
+    updated = set()
+
     with mp.Pool(nprocs) as p:
         scores_it = p.imap_unordered(
             ft.partial(
                 sanitizer_scores_project,
                 crash_database=crash_database,
                 functions_by_local_id=functions_by_local_id,
+                backend=backend,
+                cache=cache,
             ),
             bundles,
         )
         for score_list in tqdm(scores_it, total=len(bundles)):
             for function_id, sanitizer_scores in score_list:
-                meta = database[function_id]["meta"]
-                if not "metrics" in meta:
-                    meta["metrics"] = {}
-                metrics = meta["metrics"]
-                
                 total_score = 0
                 for sanitizer, score in sanitizer_scores.items():
                     key = f"sanitizer-{sanitizer}"
-                    if not key in metrics or metrics[key] < score:
-                        metrics[key] = score
-                    total_score += metrics[key]
+                    if function_id in updated:
+                        score = max(score, store.get(function_id, key))
+                    store.set(function_id, key, score)
+                    total_score += score
+                updated.add(function_id)
+
+                stamp = score_stamp(version, index.origin_count(function_id))
+                store.set(function_id, "sanitizer", total_score, stamp)
 
-                metrics["sanitizer"] = total_score
-                meta["metrics"] = metrics
-                database[function_id]["meta"] = meta
+    return updated
 
 
 def create_bundles(crash_database, functions_by_local_id, max_bundle_size):
@@ -448,30 +699,15 @@ def create_bundles(crash_database, functions_by_local_id, max_bundle_size):
     return bundles
 
 
-def sanitizer_metric(database, crash_database):
+def sanitizer_metric(function_ids, database, store, index, crash_database, version, backend="objdump", cache=None):
     crash_database = fsdict(crash_database)
-
-    # Load all function meta into RAM
-    print("[*] Load functions into ram")
-    functions = {
-        function_id: function["meta"] for function_id, function in tqdm(database.items(), total=len(database))
-    }
+    if cache != None:
+        cache = SanitizerCache(cache)
 
     with mp.Manager() as manager:
         # Map code all function locations to local ids
         print("[*] Create crash to function mapping")
-
-        functions_by_local_id = {}
-
-        for function_id, meta in tqdm(functions.items(), total=len(functions)):
-            for origin in meta["origins"]:
-                local_id = origin["crash"]
-                local_id = int(local_id)
-
-                if not local_id in functions_by_local_id:
-                    functions_by_local_id[local_id] = []
-
-                functions_by_local_id[local_id].append((function_id, origin))
+        functions_by_local_id = index.origins_by_crash(function_ids)
 
         functions_by_local_id = manager.dict(functions_by_local_id)
 
@@ -488,4 +724,11 @@ def sanitizer_metric(database, crash_database):
         bundles = create_bundles(crash_database, functions_by_local_id, max_bundle_size)
         random.shuffle(bundles)
 
-        create_scores_in_parallel(bundles, database, crash_database, functions_by_local_id, nprocs)
+        updated = create_scores_in_parallel(bundles, index, store, crash_database, functions_by_local_id, nprocs, version, backend, cache)
+
+        # Stamp functions without any score with the default score -1 (see
+        # missingscores), so that they are not retried on every run.
+        for function_id in function_ids:
+            if not function_id in updated:
+                store.set(function_id, "sanitizer", -1, score_stamp(version, index.origin_count(function_id)))
+        store.flush()
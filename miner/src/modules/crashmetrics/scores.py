@@ -0,0 +1,31 @@
+""" Book-keeping of which scores are up to date.
+
+Functions are content-addressed by the hash of their source, so a score which
+exists for a function id was calculated for the current source. Along with
+each score the score store keeps the stamp of the metric version it was
+calculated with. Scores of metrics which aggregate over the origins of a
+function also become stale once a function gets new origins.
+"""
+
+
+def score_stamp(version, origin_count=None):
+    """Stamp of a score. Pass the function's number of origins for metrics
+    which aggregate over its origins.
+    """
+    if origin_count != None:
+        return f"{version}/{origin_count}"
+    return version
+
+
+def missing_scores(store, index, function_ids, metric, version, per_origin=False):
+    """Ids of the functions whose score of the metric is missing or stale."""
+    if not per_origin:
+        missing = set(store.missing(metric, score_stamp(version)))
+        return [function_id for function_id in function_ids if function_id in missing]
+    return [
+        function_id
+        for function_id in function_ids
+        if not store.has_score(
+            function_id, metric, score_stamp(version, index.origin_count(function_id))
+        )
+    ]
@@ -2,15 +2,19 @@
 """
 
 import click
+import resource
 import numpy as np
+import functools as ft
+import multiprocessing as mp
 import matplotlib.pyplot as plt
-from collections import defaultdict
 from sklearn.metrics import ndcg_score
 from tqdm import tqdm
 from pathlib import Path
 from config import TRIVIAL_FUNCTIONS
 from fsdict import fsdict
-from itertools import groupby
+from multiprocessing.shared_memory import SharedMemory
+from utils.scorestore import ScoreStore, scores_path
+from utils.functionindex import load_index
 
 METRICS = [
     "linevul",
@@ -29,110 +33,257 @@ METRICS = [
     "all",
 ]
 
-
-def load_functions(functions_path):
-    functions = fsdict(functions_path)
-    dataset = []
-
-    for _, function in tqdm(functions.items(), total=len(functions), desc="Load functions"):
-        meta = function["meta"]
-        dataset.append(meta)
-
-    return dataset
-
-
-def create_queries(functions, metrics, ignore_functions):
-    queries = defaultdict(lambda: defaultdict(list))
-
-    for meta in tqdm(functions, desc="Create queries"):
-        origins = meta["origins"]
-        function_origins = groupby(origins, lambda origin: int(origin["crash"]))
-
-        for crash_id, crash_origins in function_origins:
-            crash_origins_init = list(crash_origins)
-            crash_origins = crash_origins_init
-            crash_origins = filter(
-                lambda origin: origin["name"].lower() not in ignore_functions,
-                crash_origins,
-            )
-            framenos = map(
-                lambda origin: origin["annotation"]["frameno"], crash_origins
-            )
-            max_frameno = max(framenos, default=-1)
-
-            is_crash = max_frameno > -1
-
-            for metric in metrics:
-                score = meta["metrics"][metric]
-                queries[crash_id][metric].append((score, is_crash))
-
-    return queries
-
-
-def queries_to_numpy(queries, metric):
-    X = []
+# Number of functions whose origins are folded into the queries at once
+LOAD_CHUNK_SIZE = 65536
+
+
+def iter_origins(index, chunk_size):
+    """Stream the origins of the index in chunks of functions."""
+    for start in range(0, len(index), chunk_size):
+        functions = index.functions[start : start + chunk_size]
+        begin = int(functions[0]["origin_offset"])
+        end = int(functions[-1]["origin_offset"] + functions[-1]["origin_count"])
+        yield start, np.array(index.origins[begin:end])
+
+
+def create_queries(index, store, ignore_functions):
+    """Fold the origins of all functions into per-crash queries. Each (crash,
+    function) pair becomes one query entry, which is labeled as crashing if
+    any of its non-trivial origins is part of the traceback.
+
+    Returns the crash id, score store row and label of each entry.
+    """
+    function_ids = index.function_ids()
+    missing = [function_id for function_id in function_ids if not function_id in store]
+    if len(missing) > 0:
+        raise click.ClickException(
+            f"{len(missing)} functions of the database are not in the score store, e.g., "
+            f"'{missing[0]}'. Calculate their scores with crashmetrics and missingscores first."
+        )
+    store_rows = np.array([store.row(function_id) for function_id in function_ids], dtype=np.int64)
+    ignored = np.array(
+        [string.lower() in ignore_functions for string in index.strings], dtype=bool
+    )
+
+    crashes = []
+    rows = []
     y = []
-    query_groups = []
-
-    for query in queries.values():
-        query_metric = query[metric]
-        if len(query_metric) == 0:
+    for start, origins in tqdm(
+        iter_origins(index, LOAD_CHUNK_SIZE),
+        total=(len(index) + LOAD_CHUNK_SIZE - 1) // LOAD_CHUNK_SIZE,
+        desc="Create queries",
+    ):
+        if len(origins) == 0:
             continue
-
-        x_query = []
-        y_query = []
-
-        for feature_vec, label in query_metric:
-            x_query.append(feature_vec)
-            y_query.append(label)
-
-        if sum(y_query) == 0:
-            continue
-
-        X += x_query
-        y += y_query
-        query_groups.append(len(query_metric))
-
-    X = np.array(X, dtype=np.float32)
-    y = np.array(y, dtype=np.uint8)
-    query_groups = np.array(query_groups, dtype=np.uint32)
+        framenos = np.where(ignored[origins["name"]], -1, origins["frameno"])
+
+        # The origins of a function in the index are sorted by crash
+        new_entry = np.ones(len(origins), dtype=bool)
+        new_entry[1:] = (origins["function"][1:] != origins["function"][:-1]) | (
+            origins["crash"][1:] != origins["crash"][:-1]
+        )
+        entries = np.flatnonzero(new_entry)
+        max_framenos = np.maximum.reduceat(framenos, entries)
+
+        crashes.append(origins["crash"][entries])
+        rows.append(store_rows[origins["function"][entries]])
+        y.append((max_framenos > -1).astype(np.uint8))
+
+    crashes = np.concatenate(crashes) if len(crashes) > 0 else np.zeros(0, dtype=np.int64)
+    rows = np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=np.int64)
+    y = np.concatenate(y) if len(y) > 0 else np.zeros(0, dtype=np.uint8)
+    return crashes, rows, y
+
+
+def queries_to_numpy(crashes, rows, y, store, metrics):
+    """Flatten the queries into segmented arrays: the labels, a score matrix
+    with one column per metric and the size of each query. Queries without
+    any crashing function are left out.
+    """
+    order = np.argsort(crashes, kind="stable")
+    crashes = crashes[order]
+    rows = rows[order]
+    y = y[order]
+
+    query_starts = np.flatnonzero(np.diff(crashes, prepend=crashes[:1] - 1))
+    query_groups = np.diff(np.append(query_starts, len(crashes)))
+    positives = np.add.reduceat(y, query_starts) if len(y) > 0 else y
+    keep = np.repeat(positives > 0, query_groups)
+
+    rows = rows[keep]
+    X = np.zeros((len(rows), len(metrics)), dtype=np.float32)
+    for column, metric in enumerate(metrics):
+        X[:, column] = store.scores(metric)[rows]
+    y = y[keep]
+    query_groups = query_groups[positives > 0].astype(np.uint32)
 
     return X, y, query_groups
 
 
-def calc_ndcg(X, y, query_groups, k):
-    scores = np.zeros(len(query_groups))
-    scores[:] = np.nan
-    cur_idx = 0
-
-    for idx, query_size in enumerate(query_groups):
-        x_query = X[cur_idx : cur_idx + query_size]
-        y_query = y[cur_idx : cur_idx + query_size]
-        cur_idx += query_size
-
-        if y_query.sum() == 0:
-            continue
-
-        score = ndcg_score([y_query], [x_query], k=k)
-        scores[idx] = score
-
-    return scores
-
-
-def plot_mean_ndcg(functions_path, output_path, metric, cutoff):
+def report_memory(step):
+    """Print the peak resident set size of this process and its children."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f"[*] Peak memory after {step}: {peak:.1f} MiB (workers: {children:.1f} MiB)")
+
+
+def ndcg_curves(X, y, query_groups, cutoff):
+    """NDCG@k of each query for all k from 1 to cutoff, identical to sklearn's
+    ndcg_score (including its averaging of the gains of tied scores).
+
+    Each query is sorted once. Only the first cutoff ranks of each query
+    matter, so the gains are gathered into a (queries x cutoff) array and the
+    DCG@k of all k are its cumulative sums. Queries with less than two
+    functions, for which sklearn refuses to calculate the NDCG, are NaN.
+    """
+    nqueries = len(query_groups)
+    query_groups = query_groups.astype(np.int64)
+    starts = np.cumsum(query_groups) - query_groups
+    query_ids = np.repeat(np.arange(nqueries), query_groups)
+
+    # Sort each query by descending score
+    scores = X.astype(np.float64)
+    labels = y.astype(np.float64)
+    order = np.lexsort((-scores, query_ids))
+    scores = scores[order]
+    labels = labels[order]
+    ranks = np.arange(len(order)) - starts[query_ids]
+
+    # Tied scores share the mean gain of their tie group
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (scores[1:] != scores[:-1]) | (query_ids[1:] != query_ids[:-1])
+    group_starts = np.flatnonzero(new_group)
+    group_sizes = np.diff(np.append(group_starts, len(order)))
+    group_gains = np.add.reduceat(labels, group_starts) / group_sizes if len(order) > 0 else labels
+    gains = np.repeat(group_gains, group_sizes)
+
+    # Gains of the top cutoff ranks. Ranks beyond a query's size gain nothing.
+    top = ranks < cutoff
+    discount = 1 / np.log2(np.arange(cutoff) + 2)
+    dcg = np.zeros((nqueries, cutoff))
+    dcg[query_ids[top], ranks[top]] = gains[top]
+    dcg = np.cumsum(dcg * discount, axis=1)
+
+    # The ideal ranking sorts each query by its labels
+    labels = y.astype(np.float64)
+    labels = labels[np.lexsort((-labels, query_ids))]
+    ideal = np.zeros((nqueries, cutoff))
+    ideal[query_ids[top], ranks[top]] = labels[top]
+    ideal = np.cumsum(ideal * discount, axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        curves = np.where(ideal > 0, dcg / ideal, 0.0)
+    curves[query_groups < 2] = np.nan
+    return curves
+
+
+def check_ndcg(X, y, query_groups, curves, nsamples=100):
+    """Compare the NDCG curves of a sample of queries against sklearn."""
+    cutoff = curves.shape[1]
+    starts = np.cumsum(query_groups) - query_groups
+    samples = [idx for idx in range(len(query_groups)) if query_groups[idx] > 1]
+    samples = np.random.default_rng(0).permutation(samples)[:nsamples]
+    for idx in samples:
+        x_query = X[starts[idx] : starts[idx] + query_groups[idx]]
+        y_query = y[starts[idx] : starts[idx] + query_groups[idx]]
+        expected = [ndcg_score([y_query], [x_query], k=k) for k in range(1, cutoff + 1)]
+        if not np.allclose(curves[idx], expected, rtol=1e-12, atol=1e-12):
+            raise AssertionError(f"NDCG of query {idx} deviates from sklearn")
+
+
+# Query arrays of the worker processes
+shared = {}
+
+
+def share_arrays(arrays):
+    """Copy the arrays into shared memory. Returns the shared memory blocks
+    and the specification to attach to them.
+    """
+    blocks = []
+    specs = {}
+    for name, array in arrays.items():
+        block = SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def attach_arrays(specs):
+    shared["blocks"] = []
+    for name, (block_name, shape, dtype) in specs.items():
+        block = SharedMemory(name=block_name)
+        shared["blocks"].append(block)
+        shared[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def evaluate_metric(column, cutoff, check):
+    """Mean NDCG@k of a metric for all k from 1 to cutoff."""
+    X = shared["X"][:, column]
+    y = shared["y"]
+    query_groups = shared["query_groups"]
+
+    curves = ndcg_curves(X, y, query_groups, cutoff)
+    if check:
+        check_ndcg(X, y, query_groups, curves)
+    return np.nanmean(curves, axis=0)
+
+
+def plot_mean_ndcg(functions_path, store_path, output_path, metric, cutoff, check, nprocs, max_memory):
     ignore_functions = set(name.lower() for name in TRIVIAL_FUNCTIONS)
     metrics = [metric] if metric != "all" else [m for m in METRICS if not m == "all"]
-    functions = load_functions(functions_path)
+    database = fsdict(functions_path)
+    index = load_index(database)
+    store = ScoreStore(store_path)
+    store.import_meta(database, index.function_ids())
+
+    # Evaluating a metric without scores must not create an empty column
+    unknown = [name for name in metrics if not store.has_metric(name)]
+    if len(unknown) == len(metrics):
+        raise click.ClickException(f"The score store has no scores of the metric '{metric}'.")
+    if len(unknown) > 0:
+        print(f"[!] Skip metrics without scores: {', '.join(unknown)}")
+        metrics = [name for name in metrics if not name in unknown]
 
     # Create queries
-    queries = create_queries(functions, metrics, ignore_functions)
-
-    for metric in tqdm(metrics, desc="Calculate scores for target selection methods"):
-        X, y, query_groups = queries_to_numpy(queries, metric)
-
-        # Calc ndcg scores
-        scores = [np.nanmean(calc_ndcg(X, y, query_groups, k)) for k in range(1, cutoff+1)]
-    
+    crashes, rows, y = create_queries(index, store, ignore_functions)
+    X, y, query_groups = queries_to_numpy(crashes, rows, y, store, metrics)
+    del crashes, rows
+
+    # Functions without a score would be ranked anywhere
+    partial = [name for column, name in enumerate(metrics) if np.isnan(X[:, column]).any()]
+    if len(partial) == len(metrics):
+        raise click.ClickException(
+            f"Some functions have no {', '.join(partial)} score. Run missingscores first."
+        )
+    if len(partial) > 0:
+        print(f"[!] Skip metrics with missing scores (run missingscores first): {', '.join(partial)}")
+        X = X[:, [column for column, name in enumerate(metrics) if not name in partial]]
+        metrics = [name for name in metrics if not name in partial]
+    if max_memory:
+        report_memory("creating the queries")
+
+    # Calc ndcg scores
+    evaluate_part = ft.partial(evaluate_metric, cutoff=cutoff, check=check)
+    columns = range(len(metrics))
+    desc = "Calculate scores for target selection methods"
+    if nprocs > 1:
+        blocks, specs = share_arrays({"X": X, "y": y, "query_groups": query_groups})
+        try:
+            with mp.Pool(min(nprocs, len(metrics)), initializer=attach_arrays, initargs=(specs,)) as p:
+                mean_scores = list(tqdm(p.imap(evaluate_part, columns), total=len(metrics), desc=desc))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    else:
+        shared.update(X=X, y=y, query_groups=query_groups)
+        mean_scores = [evaluate_part(column) for column in tqdm(columns, desc=desc)]
+
+    if max_memory:
+        report_memory("calculating the NDCG")
+
+    for metric, scores in zip(metrics, mean_scores):
         plt.plot(list(range(1, cutoff+1)), scores, label=metric)
     
     plt.title("Mean-NDCG (underastimating label-strategy)")
@@ -150,6 +301,12 @@ def plot_mean_ndcg(functions_path, output_path, metric, cutoff):
     type=click.Path(file_okay=False, dir_okay=True, exists=True, path_type=Path),
     help="Path of the functions directory.",
 )
+@click.option(
+    "--scores",
+    type=click.Path(file_okay=False, dir_okay=True, exists=True, path_type=Path),
+    default=None,
+    help="Path of the score store (default: <functions>.scores).",
+)
 @click.option(
     "--output",
     "-o",
@@ -169,9 +326,22 @@ def plot_mean_ndcg(functions_path, output_path, metric, cutoff):
     required=True,
     help="Evaluate using the <topn> highest ranking functions for each target selection method.",
 )
+@click.option(
+    "--check-ndcg",
+    is_flag=True,
+    help="Compare the NDCG of a sample of queries against sklearn's ndcg_score.",
+)
+@click.option("--nprocs", type=int, default=1, help="Number of parallel processes")
+@click.option(
+    "--max-memory",
+    is_flag=True,
+    help="Report the peak resident set size.",
+)
 @click.pass_context
-def cli(ctx, functions, output, metric, topn):
-    plot_mean_ndcg(functions, output, metric, topn)
+def cli(ctx, functions, scores, output, metric, topn, check_ndcg, nprocs, max_memory):
+    if scores == None:
+        scores = scores_path(functions)
+    plot_mean_ndcg(functions, scores, output, metric, topn, check_ndcg, nprocs, max_memory)
 
 
 if __name__ == "__main__":
@@ -6,13 +6,35 @@ import itertools as it
 import sys
 import re
 import tarfile
+import pickle
+import shutil
+import threading
+import logging
+import multiprocessing as mp
+from collections import defaultdict
+from pathlib import Path
 from tqdm import tqdm
-from utils.imfile import process_source_file, clang_format
+from utils.imfile import process_source, clang_format
 from utils.utils import *
 from utils.modules import *
 from utils.filter import filter_it
+from utils.functionindex import FunctionIndex, index_path, read_generation, bump_generation
+from utils.sourcestore import SourceStore, sources_path
+from utils.extractioncache import ExtractionCache
 from fsdict import fsdict
-from easymp import addlogging, parallel, execute
+from easymp import addlogging, parallel
+from easymp.easymp import listener_configurer
+
+
+# Number of crashes whose functions a worker groups at once
+MAP_CHUNK_SIZE = 16
+
+# Length of the source hash prefix by which the function database is sharded
+SHARD_PREFIX_LENGTH = 2
+
+# Number of preprocessed source files per process which are read from the
+# archives ahead of the workers
+MEMBERS_IN_FLIGHT = 4
 
 
 def identify_target(source):
@@ -38,29 +60,46 @@ def read_log(fuzzer):
     return summary, frames
 
 
-def func_equal(func1, func2):
-    fpath1 = func1["fpath"]
-    fpath2 = func2["origin"]["fpath"]
-    norm_fpath1 = osp.normpath(fpath1)
-    norm_fpath2 = osp.normpath(fpath2)
-    certainty = 0
-    path_eq = False
-    function_eq = False
-
-    if norm_fpath1 == norm_fpath2:
-        certainty += 1
-        path_eq = True
-    elif osp.basename(fpath1) == osp.basename(fpath2):
-        certainty += 0.5
-        path_eq = True
-    if func2["origin"]["start"] <= func1["linenum"] <= func2["origin"]["end"]:
-        certainty += 1
-        function_eq = True
-
-    return path_eq and function_eq, certainty
-
-
-def annotate(function, traceback):
+class FrameIndex:
+    """Frames of a traceback by the normalized path and the basename of their
+    file, along with their line numbers.
+    """
+
+    def __init__(self, traceback):
+        self.by_path = defaultdict(list)
+        self.by_basename = defaultdict(list)
+        for frame in traceback:
+            fpath = frame["function"]["fpath"]
+            linenum = frame["function"]["linenum"]
+            self.by_path[osp.normpath(fpath)].append((linenum, frame))
+            self.by_basename[osp.basename(fpath)].append((linenum, frame))
+
+    def match(self, origin):
+        """The frames which match a function best, in traceback order.
+
+        Frames of the same file whose line lies within the function match with
+        certainty 2, frames of a file with the same basename with certainty
+        1.5. The latter are only considered if there are no frames of the same
+        file.
+        """
+        fpath = origin["fpath"]
+        start = origin["start"]
+        end = origin["end"]
+        frames = [
+            frame
+            for linenum, frame in self.by_path.get(osp.normpath(fpath), [])
+            if start <= linenum <= end
+        ]
+        if len(frames) == 0:
+            frames = [
+                frame
+                for linenum, frame in self.by_basename.get(osp.basename(fpath), [])
+                if start <= linenum <= end
+            ]
+        return frames
+
+
+def annotate(function, frame_index):
     if not "annotation" in function:
         function["annotation"] = hashdict()
     annotation = hashdict(
@@ -69,15 +108,9 @@ def annotate(function, traceback):
         crashsite=False,
     )
 
-    frames = map(
-        lambda frame: (func_equal(frame["function"], function), frame), traceback
-    )
-    frames = list(filter(lambda frame: frame[0][0], frames))
+    # Choose the frames which match the function best
+    frames = frame_index.match(function["origin"])
     if len(frames) >= 1:
-        # Choose the frame which matches the function best
-        max_certainty = max(frames, key=lambda el: el[0][1])[0][1]
-        frames = filter(lambda frame: frame[0][1] == max_certainty, frames)
-        frames = list(map(lambda frame: frame[1], frames))
         # If the function occurs in the traceback more than once, take the lowest
         # frame number
         frame = frames[0]
@@ -94,7 +127,7 @@ def annotate(function, traceback):
 
 def annotate_functions(functions, traceback):
     # Annotate the functions
-    annotate_part = ft.partial(annotate, traceback=traceback)
+    annotate_part = ft.partial(annotate, frame_index=FrameIndex(traceback))
     functions = set(map(annotate_part, functions))
 
     return functions
@@ -125,113 +158,166 @@ def filter_functions(functions, project_name):
     return set(functions)
 
 
-@with_tempdir
 @addlogging
-def extract_source(directory, fuzzer):
-    src_fpath = fuzzer["out"].abspath / "preprocessed.tar.gz"
-    functions = set()
-
-    if not ("out" in fuzzer and "preprocessed.tar.gz" in fuzzer["out"]):
-        return functions
-
-    with tarfile.open(src_fpath, "r:gz") as tar:
-        members = list(member for member in tar if member.isreg())
-
-        # Iterate over every preprocessed source file in the archive
-        for member in members:
-            # Extract file
-            fpath = osp.join(directory, member.name)
-            tar.extract(member, path=directory)
-
-            # Rename file
-            fpath_new = re.sub(".ii$", ".cpp", fpath)
-            fpath_new = re.sub(".i$", ".c", fpath_new)
-            os.rename(fpath, fpath_new)
-            fpath = fpath_new
-
-            # Prefix preprocessed #-lines with // to be parseable by treesitter
-            source = fread(fpath)
-            match = re.search('^# [0-9]+ ".+" [0-9]+', source, flags=re.MULTILINE)
-            if not match:
-                # Likely not a valid preprocessed source file
-                continue
-            source = re.sub("^#", "//#", source, flags=re.MULTILINE)
-            fwrite(fpath, source)
-
-            # Get a list of all the functions found in the preprocessed source file
+def read_members(fuzzers, counts, in_flight):
+    """Read the preprocessed source files from the archives of the fuzzers.
+
+    Yields (fuzzer number, member name, data) for each file. Once the archive
+    of a fuzzer has been read, its number of files is stored in counts, or None
+    if the archive could not be read. Each file takes a slot of in_flight,
+    which bounds the number of files held in memory.
+    """
+    for key, (fuzzer, _, project_name) in enumerate(fuzzers):
+        count = 0
+        if "out" in fuzzer and "preprocessed.tar.gz" in fuzzer["out"]:
+            src_fpath = fuzzer["out"].abspath / "preprocessed.tar.gz"
             try:
-                new_functions = process_source_file(fpath)
-            except Exception:
-                logger.warning(
-                    f"Could not process {fpath} successfully. Maybe it was not a valid preprocessed source file or did not contain any functions."
+                with tarfile.open(src_fpath, "r:gz") as tar:
+                    for member in tar:
+                        if not member.isreg():
+                            continue
+                        data = tar.extractfile(member).read()
+                        in_flight.acquire()
+                        yield key, member.name, data
+                        count += 1
+            except (tarfile.TarError, EOFError, OSError) as exc:
+                logger.error(
+                    f"Could not read {src_fpath} of project {project_name}: {exc}"
                 )
-                continue
-            for function in new_functions:
-                functions.add(function)
+                count = None
+        counts[key] = count
 
-            # Remove extracted file
-            os.remove(fpath)
 
-    return functions
+def configure_logging():
+    """Print log records like the listener of easymp. Called in the parent
+    and in each worker, which only inherits the handler if it is forked.
+    """
+    root = logging.getLogger()
+    if len(root.handlers) == 0:
+        listener_configurer()
+    root.setLevel(logging.INFO)
 
 
-def extract_fuzzer(fuzzer, target, project_name, overwrite):
-    meta = fuzzer["meta"]
+def extract_member(item, cache=None):
+    """Extract the functions of a preprocessed source file. Returns the fuzzer
+    number, the functions, or None if the extraction failed, and whether they
+    were taken from the cache.
+    """
+    key, name, data = item
+    result = extract_source(name, data, cache)
+    if result == None:
+        return key, None, False
+    return key, *result
 
-    if not "stats" in meta:
-        meta["stats"] = {}
 
-    if not "traceback" in meta or overwrite:
-        # Extract traceback from fuzzing log
-        summary, traceback = read_log(fuzzer)
-        meta["traceback"] = traceback
+@parallel
+@addlogging
+def extract_source(name, data, cache=None):
+    functions = set()
+
+    if name.endswith(".ii"):
+        lang = "cpp"
+    elif name.endswith(".i"):
+        lang = "c"
     else:
-        traceback = meta["traceback"]
-
-    if not "functions" in fuzzer or overwrite:
-        # Extract source code functions from .i/.ii files
-        functions = extract_source(fuzzer)
-
-        if len(functions) == 0:
-            logger.warning(f"Couldn't extract any functions of project {project_name}.")
-            return
-
-        # Filter functions
-        meta["stats"]["functionsPreFilterCount"] = len(functions)
-        functions = filter_functions(functions, project_name)
-        meta["stats"]["functionsPostFilterCount"] = len(functions)
-
-        # Annotate functions according to a traceback
-        functions = annotate_functions(functions, traceback)
-        meta["stats"]["annotatedFunctionsCount"] = len(
-            list(
-                filter(
-                    lambda function: function["annotation"]["frameno"] >= 0, functions
-                )
-            )
+        # Not a preprocessed source file
+        return functions, False
+
+    if cache != None:
+        entry = cache.key(data, lang)
+        cached_functions = cache.get(entry)
+        if cached_functions != None:
+            return set(cached_functions), True
+
+    # Prefix preprocessed #-lines with // to be parseable by treesitter
+    source = data.decode("utf-8", errors="ignore")
+    match = re.search('^# [0-9]+ ".+" [0-9]+', source, flags=re.MULTILINE)
+    if not match:
+        # Likely not a valid preprocessed source file
+        return functions, False
+    source = re.sub("^#", "//#", source, flags=re.MULTILINE)
+
+    # Get a list of all the functions found in the preprocessed source file
+    try:
+        functions = set(process_source(source, lang))
+    except Exception:
+        logger.warning(
+            f"Could not process {name} successfully. Maybe it was not a valid preprocessed source file or did not contain any functions."
         )
-        meta["stats"]["annotatedCrashsite"] = any(
-            map(lambda function: function["annotation"]["crashsite"], functions)
+        return functions, False
+
+    if cache != None:
+        cache.set(entry, functions)
+
+    return functions, False
+
+
+def extract_functions(fuzzers, nprocs, cache=None):
+    """Extract the functions of the fuzzers' preprocessed source files.
+
+    The files of all fuzzers form a single work queue, so that the files of a
+    large project are spread over all processes. Yields the number of a
+    fuzzer and its functions as soon as all of its files are processed.
+    Fuzzers whose archive could not be read or one of whose files failed are
+    left out.
+    """
+    counts = {}
+    failed = set()
+    hits = 0
+    total = 0
+    done = defaultdict(int)
+    functions = defaultdict(set)
+    in_flight = threading.Semaphore(nprocs * MEMBERS_IN_FLIGHT)
+
+    with mp.Pool(nprocs, initializer=configure_logging) as p:
+        results = p.imap_unordered(
+            ft.partial(extract_member, cache=cache),
+            read_members(fuzzers, counts, in_flight),
         )
-
-        # Save results
-        fuzzer["functions"] = functions
-        fuzzer["meta"] = meta
+        try:
+            for key, member_functions, cached in results:
+                in_flight.release()
+                hits += cached
+                total += 1
+                if member_functions == None:
+                    failed.add(key)
+                else:
+                    functions[key] |= member_functions
+                done[key] += 1
+                if counts.get(key) == done[key]:
+                    key_functions = functions.pop(key, set())
+                    if not key in failed:
+                        yield key, key_functions
+                    counts[key] = None
+        finally:
+            # Unblock the reader, so that the pool can shut down
+            in_flight.release()
+
+    # Fuzzers without files or whose last file was done before their archive
+    # was closed
+    for key, count in sorted(counts.items()):
+        if count != None and not key in failed:
+            yield key, functions.pop(key, set())
+
+    if cache != None:
+        print(f"[*] Took the functions of {hits}/{total} preprocessed files from the cache")
 
 
 @parallel
 @addlogging
-def extract(crash, overwrite):
+def prepare_fuzzer(crash, overwrite):
+    """The fuzzer which originally found a crash, its traceback and project
+    name, if the functions of the fuzzer have to be extracted.
+    """
     meta = crash["meta"]
     local_id = meta["localId"]
     project_name = meta["project"]
-    project = crash["project"]
 
     if not "reproduced" in meta or not meta["reproduced"]:
         logger.warning(
             f"Cannot extract code for crash {local_id} of project {project_name}. It has not been reproduced by the original fuzzer yet."
         )
-        return
+        return None
 
     target = meta["target"]
     engine = meta["engine"]
@@ -242,55 +328,146 @@ def extract(crash, overwrite):
 
     # Only extract the source code of the "original" fuzzer.
     # That is, the one which originally found the crash.
+    fuzzer_meta = fuzzer["meta"]
+    if not "traceback" in fuzzer_meta or overwrite:
+        # Extract traceback from fuzzing log
+        summary, traceback = read_log(fuzzer)
+    else:
+        traceback = fuzzer_meta["traceback"]
+
+    if "functions" in fuzzer and not overwrite:
+        return None
+
     logger.info(f"Extract source code for crash {local_id} of project {project_name}.")
-    extract_info = extract_fuzzer(
-        fuzzer,
-        target,
-        project_name,
-        overwrite,
-    )
+    return fuzzer, traceback, project_name
+
+
+@parallel
+@addlogging
+def store_functions(fuzzer, traceback, project_name, functions):
+    meta = fuzzer["meta"]
 
-    logger.info(
-        f"Extracting source code for crash {local_id} of project {project_name}."
+    if not "stats" in meta:
+        meta["stats"] = {}
+    meta["traceback"] = traceback
+
+    if len(functions) == 0:
+        logger.warning(f"Couldn't extract any functions of project {project_name}.")
+        return
+
+    # Filter functions
+    meta["stats"]["functionsPreFilterCount"] = len(functions)
+    functions = filter_functions(functions, project_name)
+    meta["stats"]["functionsPostFilterCount"] = len(functions)
+
+    # Annotate functions according to a traceback
+    functions = annotate_functions(functions, traceback)
+    meta["stats"]["annotatedFunctionsCount"] = len(
+        list(
+            filter(
+                lambda function: function["annotation"]["frameno"] >= 0, functions
+            )
+        )
+    )
+    meta["stats"]["annotatedCrashsite"] = any(
+        map(lambda function: function["annotation"]["crashsite"], functions)
     )
 
+    # Save results
+    fuzzer["functions"] = functions
+    fuzzer["meta"] = meta
 
-def add_function_to_database(function, project, local_id, function_database):
-    origin = function["origin"]
-    annotation = function["annotation"]
-    source = function["source"]
-    source_hash = md5sum(source).hex()
-    origin["project"] = project
-    origin["crash"] = local_id
-    origin["annotation"] = annotation
 
-    if not source_hash in function_database:
-        function_database[source_hash] = fsdict()
-        function_database[source_hash]["source"] = source.encode("utf-8")
-        meta = hashdict(origins=set(), target=identify_target(source))
-    else:
-        meta = function_database[source_hash]["meta"]
+@addlogging
+def extract(crashes, nprocs, progress, overwrite, cache=None):
+    """Extract the functions of the fuzzers which originally found the
+    crashes.
+    """
+    configure_logging()
+    fuzzers = map(ft.partial(prepare_fuzzer, overwrite=overwrite), crashes)
+    fuzzers = list(filter(lambda fuzzer: fuzzer != None, fuzzers))
 
-    meta["origins"].add(origin)
-    function_database[source_hash]["meta"] = meta
+    if progress:
+        progress = tqdm(total=len(fuzzers), file=sys.stdout)
+    for key, functions in extract_functions(fuzzers, nprocs, cache):
+        store_functions(*fuzzers[key], functions)
+        if progress:
+            progress.update()
+    if progress:
+        progress.close()
 
-    return source_hash
 
+class FunctionBatch:
+    """Functions of several crashes, grouped by the hash of their source."""
 
-def add_functions_to_database(project, local_id, functions, function_database):
-    add_function_to_database_part = ft.partial(
-        add_function_to_database,
-        project=project,
-        local_id=local_id,
-        function_database=function_database,
-    )
-    function_ids = map(add_function_to_database_part, functions)
-    return set(function_ids)
+    def __init__(self):
+        self.sources = {}
+        self.origins = defaultdict(set)
+        self.fuzzers = []
 
+    def __len__(self):
+        return len(self.sources)
 
-def create_function_database(crashes, function_database, progress):
-    if progress:
-        crashes = tqdm(crashes, file=sys.stdout)
+    def add_function(self, function, project, local_id):
+        origin = function["origin"]
+        annotation = function["annotation"]
+        source = function["source"]
+        source_hash = md5sum(source).hex()
+        origin["project"] = project
+        origin["crash"] = local_id
+        origin["annotation"] = annotation
+
+        self.sources[source_hash] = source
+        self.origins[source_hash].add(origin)
+        return source_hash
+
+    def add_functions(self, fuzzer, project, local_id, functions):
+        function_ids = set(
+            self.add_function(function, project, local_id) for function in functions
+        )
+        # The function ids of a crash are only stored once its functions are
+        self.fuzzers.append((fuzzer, function_ids))
+        return function_ids
+
+
+def write_function(function_database, staging, source_hash, source, origins, packed=False):
+    """Add a function with new origins to the function database. Files are
+    written to the staging directory first and moved into place, so that
+    function directories and their meta data appear atomically. The sources
+    of packed function databases are expected to be in the source store.
+    """
+    fpath = function_database.abspath / source_hash
+    if fpath.exists():
+        with open(fpath / "meta", "rb") as f:
+            meta = pickle.loads(f.read())
+        meta["origins"] |= origins
+        with open(staging / source_hash, "wb") as f:
+            f.write(pickle.dumps(meta))
+        os.replace(staging / source_hash, fpath / "meta")
+        return
+
+    meta = hashdict(origins=set(origins), target=identify_target(source))
+    tmp_fpath = staging / source_hash
+    tmp_fpath.mkdir()
+    if not packed:
+        with open(tmp_fpath / "source", "wb") as f:
+            f.write(source.encode("utf-8"))
+    with open(tmp_fpath / "meta", "wb") as f:
+        f.write(pickle.dumps(meta))
+    os.rename(tmp_fpath, fpath)
+
+
+def shard_key(source_hash):
+    return source_hash[:SHARD_PREFIX_LENGTH]
+
+
+def map_crashes(item, staging):
+    """Group the functions of a chunk of crashes by their source and write
+    them to partial function maps, one per shard. Returns the fuzzers of the
+    crashes along with their function ids.
+    """
+    chunk_idx, crashes = item
+    batch = FunctionBatch()
     for crash in crashes:
         meta = crash["meta"]
         if not "reproduced" in meta or not meta["reproduced"]:
@@ -310,41 +487,139 @@ def create_function_database(crashes, function_database, progress):
         if not "functions" in fuzzer:
             print(f"[!] Warning: No functions for crash {local_id} of project {project}", file=sys.stderr)
             continue
-        fuzzer["functionIds"] = add_functions_to_database(
-            project, local_id, fuzzer["functions"], function_database
+        batch.add_functions(fuzzer, project, local_id, fuzzer["functions"])
+
+    shards = defaultdict(dict)
+    for source_hash, source in batch.sources.items():
+        shards[shard_key(source_hash)][source_hash] = (source, batch.origins[source_hash])
+    for shard, functions in shards.items():
+        fpath = staging / "maps" / shard / f"{chunk_idx}.pickle"
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        with open(fpath, "wb") as f:
+            pickle.dump(functions, f)
+
+    return batch.fuzzers
+
+
+def reduce_shard(shard, function_database, staging, packed):
+    """Merge the partial function maps of a shard and add its functions to
+    the function database.
+    """
+    sources = {}
+    origins = defaultdict(set)
+    # Partial maps are merged in the order of the crashes
+    fpaths = sorted((staging / "maps" / shard).iterdir(), key=lambda fpath: int(fpath.stem))
+    for fpath in fpaths:
+        with open(fpath, "rb") as f:
+            for source_hash, (source, function_origins) in pickle.load(f).items():
+                sources[source_hash] = source
+                origins[source_hash] |= function_origins
+
+    # Sources of packed function databases go to the source store before their
+    # function directories are created
+    if packed:
+        store = SourceStore(sources_path(function_database.abspath))
+        for source_hash in sorted(sources):
+            if not (function_database.abspath / source_hash).exists():
+                store.add(source_hash, sources[source_hash].encode("utf-8"))
+        store.flush()
+
+    for source_hash in sorted(sources):
+        write_function(
+            function_database,
+            staging / "functions",
+            source_hash,
+            sources[source_hash],
+            origins[source_hash],
+            packed,
         )
 
 
+def create_function_database(crashes, function_database, nprocs, progress):
+    """Add the functions of the crashes to the function database and return
+    the ids of all added or changed functions.
+
+    Workers group the functions of chunks of crashes by their source and
+    partition them into shards by the prefix of the source hash. The shards
+    are then merged in parallel, so that each function directory is written
+    once. Function directories are synced to disk before the function ids of
+    the crashes are stored. Merging again only adds origins which are already
+    there, so an interrupted run is repaired by running the extraction again.
+    """
+    # Sources of packed function databases go to the source store
+    packed = sources_path(function_database.abspath).exists()
+    # Left over files of an interrupted run are discarded
+    staging = Path(str(function_database.abspath).rstrip("/") + ".staging")
+    shutil.rmtree(staging, ignore_errors=True)
+    (staging / "maps").mkdir(parents=True)
+    (staging / "functions").mkdir()
+
+    fuzzers = []
+    items = list(enumerate(chunks(crashes, chunk_size=MAP_CHUNK_SIZE)))
+    with mp.Pool(nprocs) as p:
+        results = p.imap_unordered(ft.partial(map_crashes, staging=staging), items)
+        if progress:
+            results = tqdm(results, total=len(items), desc="Group functions", file=sys.stdout)
+        for chunk_fuzzers in results:
+            fuzzers += chunk_fuzzers
+
+        shards = sorted(fpath.name for fpath in (staging / "maps").iterdir())
+        results = p.imap_unordered(
+            ft.partial(
+                reduce_shard,
+                function_database=function_database,
+                staging=staging,
+                packed=packed,
+            ),
+            shards,
+        )
+        if progress:
+            results = tqdm(results, total=len(shards), desc="Merge shards", file=sys.stdout)
+        for _ in results:
+            pass
+    os.sync()
+
+    function_ids = set()
+    for fuzzer, crash_function_ids in fuzzers:
+        fuzzer["functionIds"] = crash_function_ids
+        function_ids |= crash_function_ids
+    shutil.rmtree(staging)
+
+    return function_ids
+
+
 def run(
     database,
     output_database,
     filter_file,
     nprocs,
     progress,
-    **kwargs,
+    overwrite,
+    cache,
 ):
     database = fsdict(database)
     crashes = list(filter_it(database, filter_file))
     shuffle(crashes)
 
     # Extract functions for each fuzzer
-    extract_part = ft.partial(
-        extract,
-        **kwargs,
-    )
-    execute(
-        extract_part,
-        it=crashes,
-        nprocs=nprocs,
-        chunksize=max(1, min(len(crashes) // nprocs, 64)),
-        progress=progress,
-        total=len(crashes),
-        progress_file=sys.stdout,
-    )
+    if cache != None:
+        cache = ExtractionCache(cache)
+    extract(crashes, nprocs, progress, overwrite, cache)
 
-    # Create a function database
+    # Create a function database. Indexes of the previous generation are
+    # stale from here on, even if the extraction is interrupted.
     function_database = fsdict(output_database)
-    create_function_database(crashes, function_database, progress)
+    previous_generation = read_generation(function_database.abspath)
+    generation = bump_generation(function_database.abspath)
+    function_ids = create_function_database(
+        crashes, function_database, nprocs, progress
+    )
+
+    # Only re-index the new and changed functions of an up-to-date index
+    index = FunctionIndex(index_path(function_database.abspath))
+    if index.generation() != previous_generation:
+        function_ids = None
+    index.update(function_database, generation, function_ids, progress=progress)
 
 
 @click.command()
@@ -376,6 +651,12 @@ def run(
     default=False,
     help="Overwrite already generated stuff (traceback, functions)",
 )
+@click.option(
+    "--cache",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory of the on-disk cache of functions per preprocessed file (disabled by default)",
+)
 def cli(*args, **kwargs):
     run(*args, **kwargs)
 
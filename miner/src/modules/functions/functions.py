@@ -0,0 +1,130 @@
+""" Maintenance of the function database.
+"""
+import os
+import click
+from fsdict import fsdict
+from tqdm import tqdm
+
+from utils.utils import chunks
+from utils.functionindex import FunctionIndex, index_path, read_generation
+from utils.sourcestore import SourceStore, sources_path
+
+
+# Number of sources which are appended to the source store at once
+PACK_CHUNK_SIZE = 8192
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option(
+    "--database",
+    "-d",
+    type=click.Path(exists=True, file_okay=False),
+    required=True,
+    help="The function database to index",
+)
+@click.option(
+    "--index",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="The index of the function database (default: <database>.index)",
+)
+@click.option("--progress", is_flag=True, help="Print progress bar (stdout)")
+def index(database, index, progress):
+    """Rebuild the index of a function database."""
+    database = fsdict(database)
+    function_index = FunctionIndex(index if index != None else index_path(database.abspath))
+    function_index.update(database, read_generation(database.abspath), progress=progress)
+    print(
+        f"[*] Indexed {len(function_index)} functions with {len(function_index.origins)} origins"
+    )
+
+
+@cli.command()
+@click.option(
+    "--database",
+    "-d",
+    type=click.Path(exists=True, file_okay=False),
+    required=True,
+    help="The function database to pack",
+)
+@click.option(
+    "--sources",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="The source store of the function database (default: <database>.sources)",
+)
+@click.option(
+    "--remove-files/--keep-files",
+    default=True,
+    help="Remove the source files of the packed functions",
+)
+@click.option("--progress", is_flag=True, help="Print progress bar (stdout)")
+def pack(database, sources, remove_files, progress):
+    """Move the sources of a function database into a source store."""
+    database = fsdict(database)
+    store = SourceStore(sources if sources != None else sources_path(database.abspath))
+    function_ids = list(database)
+    if progress:
+        progress = tqdm(total=len(function_ids), desc="Pack sources")
+
+    for chunk in chunks(function_ids, chunk_size=PACK_CHUNK_SIZE):
+        fpaths = []
+        for function_id in chunk:
+            fpath = database[function_id].abspath / "source"
+            if not fpath.exists():
+                continue
+            with open(fpath, "rb") as f:
+                store.add(function_id, f.read())
+            fpaths.append(fpath)
+        # Only remove the files once their sources are safely stored
+        store.flush()
+        if remove_files:
+            for fpath in fpaths:
+                os.remove(fpath)
+        if progress:
+            progress.update(len(chunk))
+
+    print(f"[*] Packed {len(store)} sources into '{store.path}'")
+
+
+@cli.command()
+@click.option(
+    "--database",
+    "-d",
+    type=click.Path(exists=True, file_okay=False),
+    required=True,
+    help="The function database to unpack",
+)
+@click.option(
+    "--sources",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+    help="The source store of the function database (default: <database>.sources)",
+)
+@click.option("--progress", is_flag=True, help="Print progress bar (stdout)")
+def unpack(database, sources, progress):
+    """Export the sources of the source store to the fsdict layout, i.e., a
+    source file in each function directory.
+    """
+    database = fsdict(database)
+    store = SourceStore(sources if sources != None else sources_path(database.abspath))
+    function_ids = store.ids()
+    if progress:
+        function_ids = tqdm(function_ids, desc="Unpack sources")
+
+    for function_id in function_ids:
+        if not function_id in database:
+            continue
+        fpath = database[function_id].abspath / "source"
+        if not fpath.exists():
+            with open(fpath, "wb") as f:
+                f.write(store.get(function_id))
+
+
+if __name__ == "__main__":
+    cli()
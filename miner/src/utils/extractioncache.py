@@ -0,0 +1,45 @@
+""" On-disk cache of the functions extracted from preprocessed source files.
+
+Crashes of the same project at nearby commits share most of their
+preprocessed source files. The cache maps the md5 hash of a preprocessed
+file, its language and the extraction settings to the functions extracted
+from it, i.e., their origin and source.
+"""
+
+from hashlib import md5
+
+from utils.picklecache import PickleCache
+from config import PREPARSE_DEPTH, SOURCE_FUNCTION_EXCLUDE_DIRS
+
+
+# Increment whenever the extraction of functions from a preprocessed file
+# changes its results
+CACHE_VERSION = 2
+
+
+def settings_key():
+    """Identify the settings which change the extracted functions."""
+    key = "\n".join(
+        [
+            str(CACHE_VERSION),
+            str(PREPARSE_DEPTH),
+            repr(SOURCE_FUNCTION_EXCLUDE_DIRS),
+        ]
+    )
+    return key.encode("utf-8")
+
+
+class ExtractionCache(PickleCache):
+    def __init__(self, path):
+        super().__init__(path)
+        self.settings = settings_key()
+
+    def key(self, data, lang):
+        """Key of a preprocessed file, given as bytes."""
+        digest = md5(self.settings)
+        digest.update(lang.encode("ascii") + b"\n")
+        digest.update(data)
+        return digest.hexdigest()
+
+    def encode(self, functions):
+        return list(functions)
@@ -0,0 +1,275 @@
+""" Compact index of the function database.
+
+Walking the function database means a directory entry and a meta file read
+for each of the ~450k functions. The index holds everything the downstream
+modules need from the meta files in a few packed arrays:
+
+    functions.npy  function id, offset and number of its origins,
+    origins.npy    function, project, crash id, frame number, file path,
+                   line range and name of each origin, and
+    strings.json   the string table referenced by the origins, and
+    generation     the generation of the function database it reflects.
+
+The origins of a function are stored contiguously. All arrays are memory
+mapped when loading the index.
+
+The extraction increments the generation of the function database, stored
+in <database>.generation, before it changes any functions. An index of an
+older generation is rebuilt when it is loaded. Other writes of the meta
+files, e.g., of scores, do not change the index.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+from pathlib import Path
+from tqdm import tqdm
+
+
+FUNCTION_DTYPE = np.dtype(
+    [("id", "S32"), ("origin_offset", "<u8"), ("origin_count", "<u4")]
+)
+ORIGIN_DTYPE = np.dtype(
+    [
+        ("function", "<u4"),
+        ("project", "<u4"),
+        ("crash", "<i8"),
+        ("frameno", "<i4"),
+        ("fpath", "<u4"),
+        ("start", "<i4"),
+        ("end", "<i4"),
+        ("name", "<u4"),
+    ]
+)
+
+
+def index_path(database):
+    """Default location of the index of a function database."""
+    return Path(str(database).rstrip("/") + ".index")
+
+
+def generation_path(database):
+    """Location of the generation of a function database."""
+    return Path(str(database).rstrip("/") + ".generation")
+
+
+def read_generation(database):
+    fpath = generation_path(database)
+    if not fpath.exists():
+        return 0
+    with open(fpath, "r") as f:
+        return int(f.read())
+
+
+def bump_generation(database):
+    """Increment the generation of a function database before its functions
+    are changed. Returns the new generation.
+    """
+    generation = read_generation(database) + 1
+    fpath = generation_path(database)
+    tmp_path = Path(f"{fpath}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(str(generation))
+    os.replace(tmp_path, fpath)
+    return generation
+
+
+class FunctionIndex:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.load()
+
+    def exists(self):
+        return (self.path / "functions.npy").exists()
+
+    def load(self):
+        if self.exists():
+            self.functions = np.load(self.path / "functions.npy", mmap_mode="r")
+            self.origins = np.load(self.path / "origins.npy", mmap_mode="r")
+            with open(self.path / "strings.json", "r") as f:
+                self.strings = json.load(f)
+        else:
+            self.functions = np.zeros(0, dtype=FUNCTION_DTYPE)
+            self.origins = np.zeros(0, dtype=ORIGIN_DTYPE)
+            self.strings = []
+        self.rows = None
+
+    def __len__(self):
+        return len(self.functions)
+
+    def function_ids(self):
+        return [function_id.decode("ascii") for function_id in self.functions["id"]]
+
+    def row(self, function_id):
+        if self.rows == None:
+            self.rows = {
+                function_id: row for row, function_id in enumerate(self.function_ids())
+            }
+        return self.rows[function_id]
+
+    def origin_count(self, function_id):
+        return int(self.functions[self.row(function_id)]["origin_count"])
+
+    def origin(self, idx):
+        """An origin in the format of the meta files."""
+        origin = self.origins[idx]
+        return {
+            "project": self.strings[origin["project"]],
+            "crash": int(origin["crash"]),
+            "fpath": self.strings[origin["fpath"]],
+            "start": int(origin["start"]),
+            "end": int(origin["end"]),
+            "name": self.strings[origin["name"]],
+            "annotation": {"frameno": int(origin["frameno"])},
+        }
+
+    def function_origins(self, function_id):
+        function = self.functions[self.row(function_id)]
+        offset = int(function["origin_offset"])
+        return [
+            self.origin(idx)
+            for idx in range(offset, offset + int(function["origin_count"]))
+        ]
+
+    def origins_by_crash(self, function_ids=None):
+        """Map each crash id to the (function id, origin) tuples of its
+        functions.
+        """
+        if function_ids == None:
+            idxs = range(len(self.origins))
+        else:
+            rows = [self.row(function_id) for function_id in function_ids]
+            idxs = [
+                idx
+                for row in rows
+                for idx in range(
+                    int(self.functions[row]["origin_offset"]),
+                    int(self.functions[row]["origin_offset"])
+                    + int(self.functions[row]["origin_count"]),
+                )
+            ]
+        ids = self.functions["id"]
+        functions_by_crash = {}
+        for idx in idxs:
+            origin = self.origin(idx)
+            function_id = ids[self.origins[idx]["function"]].decode("ascii")
+            if not origin["crash"] in functions_by_crash:
+                functions_by_crash[origin["crash"]] = []
+            functions_by_crash[origin["crash"]].append((function_id, origin))
+        return functions_by_crash
+
+    def generation(self):
+        """Generation of the function database the index reflects or None."""
+        fpath = self.path / "generation"
+        if not fpath.exists():
+            return None
+        with open(fpath, "r") as f:
+            return int(f.read())
+
+    def update(self, database, generation, function_ids=None, progress=False):
+        """Rebuild the index for a generation of the function database. If
+        function_ids is given, only the meta of these (new or changed)
+        functions is read and all other functions are taken from the current
+        index.
+        """
+        if function_ids == None or not self.exists():
+            function_ids = list(database)
+        function_ids = set(function_ids)
+
+        # Keep the unchanged functions and their origins
+        keep = np.array(
+            [
+                not function_id.decode("ascii") in function_ids
+                for function_id in self.functions["id"]
+            ],
+            dtype=bool,
+        )
+        new_rows = np.cumsum(keep) - 1
+        kept_origins = keep[self.origins["function"]]
+        functions = [np.array(self.functions[keep])]
+        origins = [np.array(self.origins[kept_origins])]
+        origins[0]["function"] = new_rows[origins[0]["function"]]
+
+        strings = list(self.strings)
+        string_ids = {string: idx for idx, string in enumerate(strings)}
+
+        def string_id(string):
+            if not string in string_ids:
+                string_ids[string] = len(strings)
+                strings.append(string)
+            return string_ids[string]
+
+        # Read the meta of the new and changed functions
+        row = int(keep.sum())
+        new_functions = []
+        new_origins = []
+        it = sorted(function_ids)
+        if progress:
+            it = tqdm(it, desc="Index functions")
+        for function_id in it:
+            meta = database[function_id]["meta"]
+            function_origins = sorted(
+                meta["origins"],
+                key=lambda origin: (int(origin["crash"]), origin["fpath"], origin["start"]),
+            )
+            new_functions.append((function_id, 0, len(function_origins)))
+            for origin in function_origins:
+                new_origins.append(
+                    (
+                        row,
+                        string_id(origin["project"]),
+                        int(origin["crash"]),
+                        origin["annotation"]["frameno"],
+                        string_id(origin["fpath"]),
+                        origin["start"],
+                        origin["end"],
+                        string_id(origin["name"]),
+                    )
+                )
+            row += 1
+        functions.append(np.array(new_functions, dtype=FUNCTION_DTYPE))
+        origins.append(np.array(new_origins, dtype=ORIGIN_DTYPE))
+
+        functions = np.concatenate(functions)
+        origins = np.concatenate(origins)
+        counts = functions["origin_count"].astype("<u8")
+        functions["origin_offset"] = np.cumsum(counts) - counts
+
+        self.save(functions, origins, strings, generation)
+        self.load()
+
+    def save(self, functions, origins, strings, generation):
+        tmp_path = Path(f"{self.path}.tmp")
+        old_path = Path(f"{self.path}.old")
+        for path in [tmp_path, old_path]:
+            if path.exists():
+                shutil.rmtree(path)
+        tmp_path.mkdir(parents=True)
+        np.save(tmp_path / "functions.npy", functions)
+        np.save(tmp_path / "origins.npy", origins)
+        with open(tmp_path / "strings.json", "w") as f:
+            json.dump(strings, f)
+        with open(tmp_path / "generation", "w") as f:
+            f.write(str(generation))
+
+        if self.path.exists():
+            os.rename(self.path, old_path)
+        os.rename(tmp_path, self.path)
+        if old_path.exists():
+            shutil.rmtree(old_path)
+
+
+def load_index(database, progress=False):
+    """Load the index of a function database, building it if it is missing
+    and rebuilding it if the function database changed since.
+    """
+    index = FunctionIndex(index_path(database.abspath))
+    generation = read_generation(database.abspath)
+    if not index.exists():
+        print(f"[*] Build function index '{index.path}'")
+        index.update(database, generation, progress=progress)
+    elif index.generation() != generation:
+        print(f"[*] Rebuild function index '{index.path}', the function database changed")
+        index.update(database, generation, progress=progress)
+    return index
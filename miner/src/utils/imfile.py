@@ -4,7 +4,7 @@
 import re
 import subprocess
 import os, os.path as osp
-from itertools import starmap
+from bisect import bisect_left
 from easymp import addlogging
 
 from utils.utils import *
@@ -24,6 +24,69 @@ def clang_format(function):
     return function_fmt
 
 
+LINE_MARKER = re.compile('^//# [0-9]+ "')
+LINE_MARKER_FIELDS = re.compile('^//# ([0-9]+) "(.+)" ([0-9]+).*')
+
+
+class LineMarkers:
+    """Index of the line markers of a preprocessed file.
+
+    Line markers are found once per file. Their line numbers are kept sorted,
+    so the marker preceding a line is found by bisection.
+    """
+
+    def __init__(self, lines):
+        # From https://gcc.gnu.org/onlinedocs/gcc-4.1.2/cpp/Preprocessor-Output.html
+        # Preprocessed file comment structure:
+        #   linenum filename flags
+        # flags:
+        # `1'
+        #     This indicates the start of a new file.
+        # `2'
+        #     This indicates returning to a file (after having included another file).
+        # `3'
+        #     This indicates that the following text comes from a system header file, so certain warnings should be suppressed.
+        # `4'
+        #     This indicates that the following text should be treated as being wrapped in an implicit extern "C" block.
+        self.lines = lines
+        self.linenums = []
+        self.comments = []
+        for lineno, line in enumerate(lines, start=1):
+            if not line.startswith("//# ") or LINE_MARKER.match(line) == None:
+                continue
+            if line.endswith('"'):
+                line = line + " 1"
+            self.linenums.append(lineno)
+            self.comments.append(LINE_MARKER_FIELDS.search(line).groups(0))
+
+    def pp_to_real(self, pp_lineno):
+        """Map a preprocessed file line number to the (file name, flags, line
+        number) in the source file.
+        """
+        # We count lines from zero, but the pp format lines are counted
+        # starting from one, hence the '+ 1'
+        pp_lineno += 1
+        idx = bisect_left(self.linenums, pp_lineno) - 1
+        if idx < 0:
+            return None
+        comment_lineno = self.linenums[idx]
+        closest_lineno, fname, flags = self.comments[idx]
+        real_lineno = int(closest_lineno) + (pp_lineno - comment_lineno - 1)
+        return fname, flags, real_lineno
+
+    def unmarked_lines(self, start, end):
+        """The lines[start:end] without line markers."""
+        # Line marker line numbers count from one
+        lo = bisect_left(self.linenums, start + 1)
+        hi = bisect_left(self.linenums, end + 1)
+        lines = []
+        for lineno in self.linenums[lo:hi]:
+            lines += self.lines[start : lineno - 1]
+            start = lineno
+        lines += self.lines[start:end]
+        return lines
+
+
 def process_source_file(fpath):
     """Extract functions from C/C++ source file
 
@@ -31,54 +94,29 @@ def process_source_file(fpath):
     .i/.ii information lines (i. e. lines starting with #) are expected to be
     preceded with //.
     """
-    with open(fpath, "r", encoding="utf-8", errors="ignore") as f:
-        lines = f.read().split("\n")
+    _, ext = os.path.splitext(fpath)
+    lang = ext.lower().replace(".", "")
+    assert lang == "c" or lang == "cpp"
+
+    with open(fpath, "r", encoding="utf-8", errors="ignore", newline="") as f:
+        return process_source(f.read(), lang)
+
+
+def process_source(source, lang):
+    """Extract functions from a C/C++ preprocessed source in memory
+
+    The .i/.ii information lines of the source are expected to be preceded
+    with //.
+    """
+    # Lines and parser positions have to refer to the same newlines
+    source = source.replace("\r\n", "\n").replace("\r", "\n")
+    lines = source.split("\n")
 
     # Create a mapping preprocessed file line number -> source file line number
-    # From https://gcc.gnu.org/onlinedocs/gcc-4.1.2/cpp/Preprocessor-Output.html
-    # Preprocessed file comment structure:
-    #   linenum filename flags
-    # flags:
-    # `1'
-    #     This indicates the start of a new file.
-    # `2'
-    #     This indicates returning to a file (after having included another file).
-    # `3'
-    #     This indicates that the following text comes from a system header file, so certain warnings should be suppressed.
-    # `4'
-    #     This indicates that the following text should be treated as being wrapped in an implicit extern "C" block.
-    comments = starmap(lambda lineno, line: (lineno, line), enumerate(lines, start=1))
-    comments = filter(
-        lambda lineno_line: re.match('^//# [0-9]+ "', lineno_line[1]) != None, comments
-    )
-    comments = starmap(
-        lambda lineno, line: (lineno, line + " 1")
-        if line.endswith('"')
-        else (lineno, line),
-        comments,
-    )
-    comments = {
-        lineno: re.search('^//# ([0-9]+) "(.+)" ([0-9]+).*', line).groups(0)
-        for lineno, line in comments
-    }
-    linenums = sorted([lineno for lineno in comments])
+    markers = LineMarkers(lines)
 
     # Use tree-sitter parser to parse C/C++ preprocessed file
-    functions = parser.iter_functions_file(fpath)
-
-    def pp_to_real(pp_lineno):
-        # We count lines from zero, but the pp format lines are counted
-        # starting from one, hence the '+ 1'
-        pp_lineno += 1
-        comment_linenums_before_function = list(
-            filter(lambda lineno: lineno < pp_lineno, linenums)
-        )
-        if len(comment_linenums_before_function) == 0:
-            return None
-        comment_lineno = max(comment_linenums_before_function)
-        closest_lineno, fname, flags = comments[comment_lineno]
-        real_lineno = int(closest_lineno) + (pp_lineno - comment_lineno - 1)
-        return fname, flags, real_lineno
+    functions = parser.iter_functions_bytes(source.encode("utf-8"), lang)
 
     # Extract the function from the source file
     def extract(function):
@@ -86,18 +124,14 @@ def process_source_file(fpath):
         pp_end_lineno = function["end"]
         pp_start_col = function["start_col"]
         pp_end_col = function["end_col"]
-        fname_start, flags_start, lineno_start = pp_to_real(pp_start_lineno)
-        fname_end, flags_end, lineno_end = pp_to_real(pp_end_lineno)
+        fname_start, flags_start, lineno_start = markers.pp_to_real(pp_start_lineno)
+        fname_end, flags_end, lineno_end = markers.pp_to_real(pp_end_lineno)
         if lineno_start == None or lineno_end == None or fname_start != fname_end:
             return hashdict()
         source = "\n".join(
             [
                 lines[pp_start_lineno][pp_start_col:],
-                *[
-                    line
-                    for line in lines[pp_start_lineno + 1 : pp_end_lineno - 1]
-                    if re.match('^//# [0-9]+ "', line) == None
-                ],
+                *markers.unmarked_lines(pp_start_lineno + 1, pp_end_lineno - 1),
                 lines[min(pp_end_lineno - 1, len(lines) - 1)][:pp_end_col],
             ]
         )
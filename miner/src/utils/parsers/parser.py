@@ -1,4 +1,7 @@
 import os
+import re
+import numpy as np
+from bisect import bisect_left
 from tree_sitter import Language, Parser
 from utils.utils import hashdict
 from config import PREPARSE_DEPTH
@@ -7,41 +10,45 @@ try:
     C_LANGUAGE = Language("utils/parsers/build/languages.so", "c")
     CPP_LANGUAGE = Language("utils/parsers/build/languages.so", "cpp")
 
-    # For c-style functions
-    QUERY_FUNCS_C = C_LANGUAGE.query(
+    # Queries capturing each function definition together with its name (C)
+    # or the subtree of its identifier (C++)
+    QUERY_FUNCS_NAME_C = C_LANGUAGE.query(
         """
     (function_definition
       [
         (function_declarator
-          (identifier)
+          (identifier) @name
         )
         (pointer_declarator
           (function_declarator
-            (identifier)
+            (identifier) @name
           )
         )
       ]
     ) @function
     """
     )
-    QUERY_FUNC_NAME_C = C_LANGUAGE.query(
+    QUERY_FUNCS_IDENTIFIER_SUBTREE_CPP = CPP_LANGUAGE.query(
         """
-    (function_definition
+    (function_definition 
       [
-        (function_declarator
-          (identifier) @name
-        )
-        (pointer_declarator
-          (function_declarator
-            (identifier) @name
-          )
-        )
+        (function_declarator (identifier) @subtree)
+        (function_declarator (qualified_identifier) @subtree)
+        (function_declarator (operator_name) @subtree)
+        (function_declarator (field_identifier) @subtree)
+        (pointer_declarator (function_declarator (identifier) @subtree))
+        (pointer_declarator (function_declarator (qualified_identifier) @subtree))
+        (pointer_declarator (function_declarator (operator_name) @subtree))
+        (pointer_declarator (function_declarator (field_identifier) @subtree))
+        (reference_declarator (function_declarator (identifier) @subtree))
+        (reference_declarator (function_declarator (qualified_identifier) @subtree))
+        (reference_declarator (function_declarator (operator_name) @subtree))
+        (reference_declarator (function_declarator (field_identifier) @subtree))
       ]
-    )
+    ) @function
     """
     )
-
-    # For cpp-style functions
+    # Query each C++ function definition
     QUERY_FUNCS_CPP = CPP_LANGUAGE.query(
         """
     (function_definition 
@@ -61,27 +68,7 @@ try:
     ) @function
     """
     )
-
-    QUERY_FUNC_IDENTIFIER_SUBTREE = CPP_LANGUAGE.query(
-        """
-    (function_definition 
-      [
-        (function_declarator (identifier) @subtree)
-        (function_declarator (qualified_identifier) @subtree)
-        (function_declarator (operator_name) @subtree)
-        (function_declarator (field_identifier) @subtree)
-        (pointer_declarator (function_declarator (identifier) @subtree))
-        (pointer_declarator (function_declarator (qualified_identifier) @subtree))
-        (pointer_declarator (function_declarator (operator_name) @subtree))
-        (pointer_declarator (function_declarator (field_identifier) @subtree))
-        (reference_declarator (function_declarator (identifier) @subtree))
-        (reference_declarator (function_declarator (qualified_identifier) @subtree))
-        (reference_declarator (function_declarator (operator_name) @subtree))
-        (reference_declarator (function_declarator (field_identifier) @subtree))
-      ]
-    )
-    """
-    )
+    # Query the name within the identifier subtree of a C++ function
     QUERY_FUNC_NAME_CPP = CPP_LANGUAGE.query(
         """
     [
@@ -91,9 +78,17 @@ try:
     ]
     """
     )
+
+    LANGUAGES = {"c": C_LANGUAGE, "cpp": CPP_LANGUAGE}
 except OSError:
     print("\nWARNING! Parsers not available.\n")
 
+# Leaf node types which are the name of a function themselves
+NAME_NODE_TYPES = ["identifier", "field_identifier"]
+
+# Parsers of this process by language
+PARSERS = {}
+
 
 def print_tree(node, depth=0):
     print("%s%s" % (" " * depth * 2, node))
@@ -102,36 +97,40 @@ def print_tree(node, depth=0):
         print_tree(node, depth + 1)
 
 
-def get_name(function, is_cpp=False):
+def get_name(nodes, is_cpp=False):
+    """Name of a function, given the names (C) or identifier subtrees (C++)
+    captured within the function. Functions with nested function definitions
+    have more than one and remain unnamed.
+    """
     if is_cpp:
-        subtrees = QUERY_FUNC_IDENTIFIER_SUBTREE.captures(function)
-        if len(subtrees) != 1:
+        if len(nodes) != 1:
             # print("WARNING! Invalid number of identifier subtrees.", function)
             return ""
-        subtree, _ = subtrees[0]
-        name_matches = QUERY_FUNC_NAME_CPP.captures(subtree)
+        subtree = nodes[0]
+        if subtree.type in NAME_NODE_TYPES:
+            name_matches = [subtree]
+        else:
+            name_matches = [node for node, _ in QUERY_FUNC_NAME_CPP.captures(subtree)]
     else:
-        name_matches = QUERY_FUNC_NAME_C.captures(function)
+        name_matches = nodes
     if len(name_matches) != 1:
         # print("WARNING! Invalid number of name matches for function", function)
         return ""
-    return name_matches[0][0].text.decode("ascii")
+    return name_matches[0].text.decode("ascii")
 
 
-def parse_bytes(data, lang):
-    # Create parser
-    parser = Parser()
-
-    # Set language
-    if lang == "c":
-        parser.set_language(C_LANGUAGE)
-    elif lang == "cpp":
-        parser.set_language(CPP_LANGUAGE)
+def get_parser(lang):
+    """The parser of this process for the language."""
+    if not lang in PARSERS:
+        parser = Parser()
+        if lang in LANGUAGES:
+            parser.set_language(LANGUAGES[lang])
+        PARSERS[lang] = parser
+    return PARSERS[lang]
 
-    # Parse data
-    tree = parser.parse(data)
 
-    return tree
+def parse_bytes(data, lang):
+    return get_parser(lang).parse(data)
 
 
 def parse_file(fpath):
@@ -147,14 +146,34 @@ def parse_file(fpath):
 
 
 def treesitter_iter_functions_tree(tree, lang):
-    # Query functions
+    # Query functions along with their names or identifier subtrees
     if lang == "c":
-        functions = QUERY_FUNCS_C.captures(tree.root_node)
+        captures = [
+            (match["function"], match["name"])
+            for _, match in QUERY_FUNCS_NAME_C.matches(tree.root_node)
+        ]
+        functions = sorted(
+            set(function for function, _ in captures), key=lambda node: node.start_byte
+        )
     elif lang == "cpp":
-        functions = QUERY_FUNCS_CPP.captures(tree.root_node)
+        captures = [
+            (match["function"], match["subtree"])
+            for _, match in QUERY_FUNCS_IDENTIFIER_SUBTREE_CPP.matches(tree.root_node)
+        ]
+        functions = [function for function, _ in QUERY_FUNCS_CPP.captures(tree.root_node)]
+    captures.sort(key=lambda capture: capture[0].start_byte)
+    capture_starts = [function.start_byte for function, _ in captures]
 
-    for function, _ in functions:
-        name = get_name(function, is_cpp=lang == "cpp")
+    for function in functions:
+        # Captures of the function and of the functions nested in it
+        lo = bisect_left(capture_starts, function.start_byte)
+        hi = bisect_left(capture_starts, function.end_byte)
+        nodes = [
+            node
+            for nested_function, node in captures[lo:hi]
+            if nested_function.end_byte <= function.end_byte
+        ]
+        name = get_name(nodes, is_cpp=lang == "cpp")
         start = function.start_point[0]
         end = function.end_point[0] + 1
         start_col = function.start_point[1]
@@ -190,48 +209,41 @@ def traverse_inorder(data, root_node):
         yield from traverse_inorder(data, child)
 
 
+# Tokens of the block pre-parser: escaped characters, (possibly unterminated)
+# string and character literals, and braces
+BLOCK_TOKENS = re.compile(
+    r"""\\.|"(?:[^"\\]|\\.)*(?:"|\\?\Z)|'(?:[^'\\]|\\.)*(?:'|\\?\Z)|[{}]""",
+    re.DOTALL,
+)
+
+
 def create_block_tree(data, max_depth):
     """
 
     Read the data and return a tree of blocks { ... }.
+
+    Braces within string or character literals and escaped braces are
+    ignored. The regular expression skips everything else, so only the
+    braces are handled in Python.
     """
-    data = data.decode("utf-8", errors="ignore")
+    if isinstance(data, bytes):
+        data = data.decode("utf-8", errors="ignore")
     root_node = hashdict(start=0, end=len(data), children=[], parent=None)
     current_node = root_node
-    in_double_quotes = False
-    in_single_quotes = False
-    escape = False
     depth = 0
-    for idx in range(0, len(data)):
-        if escape:
-            escape = False
-            continue
-        if data[idx] == "\\":
-            # Escape
-            escape = True
-            continue
-        if not in_single_quotes and data[idx] == '"':
-            # Double quotes
-            in_double_quotes ^= True
-            continue
-        if not in_double_quotes and data[idx] == "'":
-            # Single quotes
-            in_single_quotes ^= True
-            continue
-
-        if in_double_quotes or in_single_quotes:
-            continue
+    for match in BLOCK_TOKENS.finditer(data):
+        token = match.group()
+        idx = match.start()
 
         # Block start
-        if data[idx] == "{":
+        if token == "{":
             if depth < max_depth:
                 node = hashdict(start=idx, end=None, children=[], parent=current_node)
                 current_node["children"].append(node)
                 current_node = node
             depth += 1
-            continue
         # Block end
-        if data[idx] == "}":
+        elif token == "}":
             depth -= 1
             if depth < max_depth:
                 current_node["end"] = idx + 1
@@ -245,7 +257,7 @@ def expand_backwards(data, blocks):
     Set the start of the block backwards right after a ";", ":", or "}"
     """
     adjusted_blocks = []
-    string = data.decode("utf-8", errors="ignore")
+    string = data.decode("utf-8", errors="ignore") if isinstance(data, bytes) else data
     for block_start, block_end in blocks:
         # Trivial case block_start is beginning of data
         if block_start == 0:
@@ -269,22 +281,52 @@ def expand_backwards(data, blocks):
     return adjusted_blocks
 
 
-def node_iter_functions_bytes(data, node, lang):
+class SourceBuffer:
+    """A source file decoded once, along with its utf-8 encoding and the
+    offsets of its newlines.
+
+    Blocks are located by character offsets in the decoded text. Their bytes
+    are handed to tree-sitter as memoryviews into the encoded buffer.
+    """
+
+    def __init__(self, data):
+        self.text = data.decode("utf-8", errors="ignore")
+        self.data = self.text.encode("utf-8")
+        self.view = memoryview(self.data)
+        buffer = np.frombuffer(self.data, dtype=np.uint8)
+        self.newlines = np.flatnonzero(buffer == ord("\n"))
+        if len(self.data) == len(self.text):
+            # ASCII only, character and byte offsets are the same
+            self.byte_offsets = None
+        else:
+            # Continuation bytes do not start a character
+            starts = np.flatnonzero((buffer & 0xC0) != 0x80)
+            self.byte_offsets = np.append(starts, len(self.data))
+
+    def byte_offset(self, idx):
+        if idx == None:
+            return len(self.data)
+        if self.byte_offsets is None:
+            return min(idx, len(self.data))
+        return int(self.byte_offsets[min(idx, len(self.text))])
+
+    def line(self, idx):
+        """Line number of a character offset."""
+        return int(np.searchsorted(self.newlines, self.byte_offset(idx)))
+
+    def slice(self, start, end):
+        return self.view[self.byte_offset(start) : self.byte_offset(end)]
+
+
+def node_iter_functions_bytes(source, node, lang):
     for child in node["children"]:
-        yield from node_iter_functions_bytes(data, child, lang)
+        yield from node_iter_functions_bytes(source, child, lang)
     adjusted_block_start, block_end = expand_backwards(
-        data, [(node["start"], node["end"])]
+        source.text, [(node["start"], node["end"])]
     )[0]
-    line_offset = max(
-        0,
-        len(data.decode("utf-8", errors="ignore")[:adjusted_block_start].split("\n"))
-        - 1,
-    )
+    line_offset = source.line(adjusted_block_start)
     functions = treesitter_iter_functions_bytes(
-        data.decode("utf-8", errors="ignore")[adjusted_block_start:block_end].encode(
-            "utf-8"
-        ),
-        lang,
+        source.slice(adjusted_block_start, block_end), lang
     )
     for function in functions:
         function["start"] += line_offset
@@ -299,11 +341,12 @@ def iter_functions_bytes(data, lang):
     break the file into pieces until each piece can either not be broken
     down any further or consists of a single function definition only.
     """
-    root_node = create_block_tree(data, PREPARSE_DEPTH)
+    source = SourceBuffer(data)
+    root_node = create_block_tree(source.text, PREPARSE_DEPTH)
     functions = {}
     # Remove duplicates and use shorter function variant for ambigious
     # functions
-    for function in node_iter_functions_bytes(data, root_node, lang):
+    for function in node_iter_functions_bytes(source, root_node, lang):
         if function["end"] not in functions:
             functions[function["end"]] = function
         elif function["start"] > functions[function["end"]]["start"]:
@@ -0,0 +1,163 @@
+""" Match the file path of a function to the paths of a build or checkout.
+
+The file paths of the functions stem from the preprocessed source files and
+usually differ from the paths of the checkout or the debug information of a
+fuzzer in their prefix. A file path matches the candidate path with the
+longest common suffix, of equally good candidates the first one, as long as
+both have the same file name.
+
+Instead of comparing a file path with each candidate, the candidates are
+kept in a trie of their reversed paths. Each edge is a path component
+including its separator, e.g., /src/lib/foo.c is stored as
+
+    "c.oof/" -> "bil/" -> "crs/"
+
+A lookup follows the components of the file path and thus takes time
+proportional to its length. Where it stops, the candidates diverge within a
+component, and those with the longest common prefix of that component are
+neighbours of it in the sorted components of the node.
+"""
+
+import re
+import posixpath
+from bisect import bisect_left
+from collections import defaultdict
+
+
+# Components of a reversed path, each up to and including its separator
+COMPONENT = re.compile("[^/]*/|[^/]+")
+
+
+def reversed_components(fpath):
+    return COMPONENT.findall(fpath[::-1])
+
+
+def common_prefix_length(str1, str2):
+    for idx, (char1, char2) in enumerate(zip(str1, str2)):
+        if char1 != char2:
+            return idx
+    return min(len(str1), len(str2))
+
+
+class Node:
+    __slots__ = ["children", "indices", "first", "components"]
+
+    def __init__(self, first):
+        self.children = {}
+        # Candidates whose path ends at this node
+        self.indices = []
+        # First candidate in the subtree of this node
+        self.first = first
+        # Sorted components of the children, created on the first lookup
+        self.components = None
+
+    def sorted_components(self):
+        if self.components == None:
+            self.components = sorted(self.children)
+        return self.components
+
+    def iter_indices(self):
+        yield from self.indices
+        for child in self.children.values():
+            yield from child.iter_indices()
+
+
+class PathMatcher:
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.by_name = defaultdict(list)
+        self.root = Node(first=0)
+        for idx, fpath in enumerate(self.paths):
+            self.by_name[posixpath.basename(fpath)].append(idx)
+            node = self.root
+            for component in reversed_components(fpath):
+                if not component in node.children:
+                    node.children[component] = Node(first=idx)
+                node = node.children[component]
+            node.indices.append(idx)
+
+    def iter_groups(self, fpath):
+        """Groups of candidates with the same common suffix with a file path,
+        ordered from the longest to the shortest suffix. Each group is a tuple
+        of the length of the suffix and the nodes whose subtrees hold the
+        candidates, along with the candidates that end at a node.
+        """
+        components = reversed_components(fpath)
+        path = [self.root]
+        lengths = [0]
+        for component in components:
+            child = path[-1].children.get(component)
+            if child == None:
+                break
+            path.append(child)
+            lengths.append(lengths[-1] + len(component))
+
+        if len(components) == 0:
+            yield 0, [self.root], []
+            return
+
+        # The last component of the file path is matched like its siblings,
+        # which it may be a prefix of
+        if len(path) > len(components):
+            path.pop()
+            lengths.pop()
+
+        for depth in reversed(range(len(path))):
+            node = path[depth]
+            component = components[depth]
+            siblings = node.sorted_components()
+            # Expand the range of children around the component of the file
+            # path in the order of their common prefix with it. The subtree
+            # of the component itself was part of the previous groups.
+            left = bisect_left(siblings, component) - 1
+            right = left + 1
+            if depth < len(components) - 1 and right < len(siblings) and siblings[right] == component:
+                right += 1
+            ended = False
+            while left >= 0 or right < len(siblings):
+                left_length = common_prefix_length(component, siblings[left]) if left >= 0 else -1
+                right_length = common_prefix_length(component, siblings[right]) if right < len(siblings) else -1
+                length = max(left_length, right_length)
+                nodes = []
+                while left >= 0 and common_prefix_length(component, siblings[left]) == length:
+                    nodes.append(node.children[siblings[left]])
+                    left -= 1
+                while right < len(siblings) and common_prefix_length(component, siblings[right]) == length:
+                    nodes.append(node.children[siblings[right]])
+                    right += 1
+                # Candidates whose path ends here share no part of the component
+                ended = length == 0
+                yield lengths[depth] + length, nodes, node.indices if ended else []
+            if not ended and len(node.indices) > 0:
+                yield lengths[depth], [], node.indices
+
+    def match(self, fpath, accept=None):
+        """Index of the candidate with the longest common suffix with a file
+        path among those accept holds for. Of equally good candidates, the
+        first one is returned. Returns None if there is no such candidate or
+        if it has a different file name than the file path.
+        """
+        name = posixpath.basename(fpath)
+        if not name in self.by_name:
+            return None
+
+        for length, nodes, indices in self.iter_groups(fpath):
+            # Candidates with the same file name share at least the file name
+            if length < len(name):
+                return None
+            if accept == None:
+                candidates = [node.first for node in nodes] + indices[:1]
+            else:
+                candidates = [
+                    idx
+                    for node in nodes
+                    for idx in node.iter_indices()
+                    if accept(idx)
+                ]
+                candidates += [idx for idx in indices if accept(idx)]
+            if len(candidates) > 0:
+                best = min(candidates)
+                if posixpath.basename(self.paths[best]) != name:
+                    return None
+                return best
+        return None
@@ -0,0 +1,49 @@
+""" On-disk cache of compressed pickles, keyed by hex digests.
+
+Each entry is stored as
+
+    <key[:2]>/<key>.pickle.z
+
+which is written to a temporary file and renamed, so that several processes
+can add entries concurrently. Subclasses define the keys and may encode the
+values before they are pickled.
+"""
+
+import os
+import zlib
+import pickle
+from pathlib import Path
+
+
+class PickleCache:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def encode(self, value):
+        return value
+
+    def decode(self, value):
+        return value
+
+    def entry_path(self, key):
+        return self.path / key[:2] / f"{key}.pickle.z"
+
+    def get(self, key):
+        """The cached value of a key or None."""
+        try:
+            with open(self.entry_path(key), "rb") as f:
+                return self.decode(pickle.loads(zlib.decompress(f.read())))
+        except FileNotFoundError:
+            return None
+        except (zlib.error, pickle.UnpicklingError, EOFError, KeyError):
+            # A corrupted entry is calculated again
+            return None
+
+    def set(self, key, value):
+        fpath = self.entry_path(key)
+        fpath.parent.mkdir(exist_ok=True)
+        tmp_path = fpath.with_name(f"{fpath.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(zlib.compress(pickle.dumps(self.encode(value)), 1))
+        os.replace(tmp_path, fpath)
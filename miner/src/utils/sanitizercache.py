@@ -0,0 +1,69 @@
+""" On-disk cache of the sanitizer scores of fuzzer binaries.
+
+Crashes of a project which were reproduced with the same target and commit
+share the same fuzzer binary. The cache maps the md5 hash of a binary and the
+disassembly backend to the table of its functions, i.e., their name, source
+file, line and sanitizer calls. Each entry is stored column-wise, with the
+source files deduplicated.
+"""
+
+from array import array
+from hashlib import md5
+
+from utils.picklecache import PickleCache
+
+
+# Increment whenever the sanitizer scores of a binary change
+CACHE_VERSION = 1
+
+# Size of the blocks in which binaries are read for hashing
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def encode_scores(scores):
+    """Store the table of sanitizer scores column-wise."""
+    files = {}
+    sanitizers = list(scores[0][3]) if len(scores) > 0 else []
+    names = []
+    file_ids = array("I")
+    lines = array("i")
+    counts = {sanitizer: array("I") for sanitizer in sanitizers}
+    for name, source_file, line, san_scores in scores:
+        names.append(name)
+        file_ids.append(files.setdefault(source_file, len(files)))
+        lines.append(line)
+        for sanitizer in sanitizers:
+            counts[sanitizer].append(san_scores[sanitizer])
+    return dict(names=names, files=list(files), file_ids=file_ids, lines=lines, counts=counts)
+
+
+def decode_scores(columns):
+    files = columns["files"]
+    counts = columns["counts"]
+    return [
+        (
+            name,
+            files[file_id],
+            line,
+            {sanitizer: counts[sanitizer][idx] for sanitizer in counts},
+        )
+        for idx, (name, file_id, line) in enumerate(
+            zip(columns["names"], columns["file_ids"], columns["lines"])
+        )
+    ]
+
+
+class SanitizerCache(PickleCache):
+    def key(self, elf_path, backend):
+        """Key of a binary and the backend counting its sanitizer calls."""
+        digest = md5(f"{CACHE_VERSION}\n{backend}\n".encode("ascii"))
+        with open(elf_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def encode(self, scores):
+        return encode_scores(scores)
+
+    def decode(self, columns):
+        return decode_scores(columns)
@@ -0,0 +1,196 @@
+""" Columnar store for the scores of the function database.
+
+Instead of rewriting each function's meta for every score, the scores of each
+metric are kept in a single memory-mapped float64 array. Row i of every array
+belongs to the i-th function id of ids.bin. Function ids are only ever
+appended, so rows are stable. Missing scores are NaN. The store directory
+holds
+
+    ids.bin               function ids (32 byte hex md5 hashes),
+    <metric>.bin          float64 scores of the metric,
+    <metric>.stamps.bin   int32 code of the version stamp of each score,
+    <metric>.stamps.json  code -> version stamp, and
+    meta-imported         marker of the import of the scores in the meta of
+                          the functions.
+
+Metrics are written to separate files, so concurrent jobs of different
+metrics do not interfere. Appending to any of the files is serialized with a
+lock file.
+"""
+
+import numpy as np
+from pathlib import Path
+from tqdm import tqdm
+
+from utils.utils import json_read, json_write, locked
+
+
+ID_DTYPE = np.dtype("S32")
+SCORE_DTYPE = np.dtype("<f8")
+STAMP_DTYPE = np.dtype("<i4")
+
+
+def scores_path(database):
+    """Default location of the score store of a function database."""
+    return Path(str(database).rstrip("/") + ".scores")
+
+
+class ScoreStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ids_path = self.path / "ids.bin"
+        self.columns = {}
+        self.stamp_columns = {}
+        self.stamp_codes = {}
+        self.load_ids()
+
+    def __reduce__(self):
+        # Worker processes reopen the store instead of copying its arrays
+        return (self.__class__, (self.path,))
+
+    def load_ids(self):
+        if self.ids_path.exists():
+            ids = np.fromfile(self.ids_path, dtype=ID_DTYPE)
+        else:
+            ids = np.zeros(0, dtype=ID_DTYPE)
+        self.ids = [function_id.decode("ascii") for function_id in ids]
+        self.rows = {function_id: row for row, function_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, function_id):
+        return function_id in self.rows
+
+    def row(self, function_id):
+        return self.rows[function_id]
+
+    def add_functions(self, function_ids):
+        """Assign rows to all new function ids."""
+        if all(function_id in self.rows for function_id in function_ids):
+            return
+        with locked(self.path):
+            self.load_ids()
+            new_ids = sorted(
+                set(function_id for function_id in function_ids if not function_id in self.rows)
+            )
+            with open(self.ids_path, "ab") as f:
+                f.write(np.array(new_ids, dtype=ID_DTYPE).tobytes())
+            self.load_ids()
+        # Columns have to be grown to the new number of rows
+        self.columns = {}
+        self.stamp_columns = {}
+
+    def has_metric(self, metric):
+        return (self.path / f"{metric}.bin").exists()
+
+    def metrics(self):
+        return sorted(
+            fpath.name[: -len(".bin")]
+            for fpath in self.path.glob("*.bin")
+            if fpath.name != "ids.bin" and not fpath.name.endswith(".stamps.bin")
+        )
+
+    def open_column(self, fpath, dtype, fill_value):
+        """Memory-map a column, growing it to the current number of rows."""
+        size = fpath.stat().st_size // dtype.itemsize if fpath.exists() else 0
+        if size < len(self.ids):
+            with locked(self.path):
+                size = fpath.stat().st_size // dtype.itemsize if fpath.exists() else 0
+                if size < len(self.ids):
+                    with open(fpath, "ab") as f:
+                        f.write(np.full(len(self.ids) - size, fill_value, dtype=dtype).tobytes())
+        if len(self.ids) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(fpath, dtype=dtype, mode="r+", shape=(len(self.ids),))
+
+    def scores(self, metric):
+        """All scores of a metric, NaN for missing scores."""
+        if not metric in self.columns:
+            self.columns[metric] = self.open_column(
+                self.path / f"{metric}.bin", SCORE_DTYPE, np.nan
+            )
+        return self.columns[metric]
+
+    def stamps(self, metric):
+        if not metric in self.stamp_columns:
+            self.stamp_columns[metric] = self.open_column(
+                self.path / f"{metric}.stamps.bin", STAMP_DTYPE, -1
+            )
+        return self.stamp_columns[metric]
+
+    def load_stamp_codes(self, metric):
+        fpath = self.path / f"{metric}.stamps.json"
+        self.stamp_codes[metric] = json_read(fpath) if fpath.exists() else {}
+
+    def stamp_code(self, metric, stamp):
+        """Code of a version stamp, which is added if it is new."""
+        if not metric in self.stamp_codes:
+            self.load_stamp_codes(metric)
+        if not stamp in self.stamp_codes[metric]:
+            with locked(self.path):
+                self.load_stamp_codes(metric)
+                codes = self.stamp_codes[metric]
+                if not stamp in codes:
+                    codes[stamp] = len(codes)
+                    fpath = self.path / f"{metric}.stamps.json"
+                    json_write(fpath, codes)
+        return self.stamp_codes[metric][stamp]
+
+    def get(self, function_id, metric, default=None):
+        score = self.scores(metric)[self.row(function_id)]
+        return default if np.isnan(score) else float(score)
+
+    def set(self, function_id, metric, score, stamp=None):
+        row = self.row(function_id)
+        self.scores(metric)[row] = score
+        if stamp != None:
+            self.stamps(metric)[row] = self.stamp_code(metric, stamp)
+
+    def known_stamp_code(self, metric, stamp):
+        """Code of a version stamp or None if no score has the stamp."""
+        if not metric in self.stamp_codes or not stamp in self.stamp_codes[metric]:
+            self.load_stamp_codes(metric)
+        return self.stamp_codes[metric].get(stamp)
+
+    def has_score(self, function_id, metric, stamp):
+        """Whether the function has a score of the metric with the stamp."""
+        row = self.row(function_id)
+        code = self.known_stamp_code(metric, stamp)
+        if code == None or np.isnan(self.scores(metric)[row]):
+            return False
+        return self.stamps(metric)[row] == code
+
+    def missing(self, metric, stamp):
+        """Ids of all functions without a score of the metric with the stamp."""
+        code = self.known_stamp_code(metric, stamp)
+        if code == None:
+            return list(self.ids)
+        missing = np.isnan(self.scores(metric)) | (self.stamps(metric) != code)
+        return [self.ids[row] for row in np.flatnonzero(missing)]
+
+    def flush(self):
+        for column in [*self.columns.values(), *self.stamp_columns.values()]:
+            if isinstance(column, np.memmap):
+                column.flush()
+
+    def import_meta(self, database, function_ids):
+        """Copy the scores in the meta of the functions, e.g., of a downloaded
+        function database, into the store once. Scores which are already in
+        the store are kept. Imported scores have no version stamp.
+        """
+        marker = self.path / "meta-imported"
+        if marker.exists():
+            return
+        self.add_functions(function_ids)
+        for function_id in tqdm(function_ids, desc="Import scores"):
+            meta = database[function_id]["meta"]
+            row = self.row(function_id)
+            for metric, score in meta.get("metrics", {}).items():
+                scores = self.scores(metric)
+                if np.isnan(scores[row]):
+                    scores[row] = score
+        self.flush()
+        marker.touch()
+
@@ -0,0 +1,169 @@
+""" Packed store for the sources of the function database.
+
+Storing each source as its own file means one inode and one small-file read
+per function. The source store appends the sources to large segment files
+instead. The store directory holds
+
+    segment-<n>.bin  concatenated sources, at most SEGMENT_SIZE bytes each, and
+    index.npy        the (hash, segment, offset, length) of each source,
+                     sorted by hash.
+
+Segments are only ever appended to and the index is replaced atomically, so
+that readers can safely memory-map the segments while another process adds
+new sources. Reads return zero-copy memoryviews into the memory-mapped
+segments.
+"""
+
+import os
+import mmap
+import numpy as np
+from pathlib import Path
+
+from utils.utils import locked
+
+
+INDEX_DTYPE = np.dtype(
+    [("hash", "S32"), ("segment", "<u4"), ("offset", "<u8"), ("length", "<u4")]
+)
+SEGMENT_SIZE = 1 << 30
+
+
+def sources_path(database):
+    """Default location of the source store of a function database."""
+    return Path(str(database).rstrip("/") + ".sources")
+
+
+class SourceStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.path / "index.npy"
+        self.segments = {}
+        self.pending = {}
+        self.load()
+
+    def __reduce__(self):
+        # Worker processes reopen the store instead of copying its index
+        return (self.__class__, (self.path,))
+
+    def segment_path(self, segment):
+        return self.path / f"segment-{segment}.bin"
+
+    def load(self):
+        if self.index_path.exists():
+            self.index = np.load(self.index_path, mmap_mode="r")
+        else:
+            self.index = np.zeros(0, dtype=INDEX_DTYPE)
+        # Views handed out keep their segment mapped
+        self.segments = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def find(self, key):
+        """Position of a hash in the index or None."""
+        idx = int(np.searchsorted(self.index["hash"], key))
+        if idx < len(self.index) and self.index[idx]["hash"] == key:
+            return idx
+        return None
+
+    def __contains__(self, source_hash):
+        return self.find(source_hash.encode("ascii")) != None
+
+    def ids(self):
+        return [key.decode("ascii") for key in self.index["hash"]]
+
+    def segment(self, segment):
+        if not segment in self.segments:
+            with open(self.segment_path(segment), "rb") as f:
+                self.segments[segment] = memoryview(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                )
+        return self.segments[segment]
+
+    def get(self, source_hash):
+        """Return the source of a function as a read-only memoryview."""
+        entry = self.index[self.find(source_hash.encode("ascii"))]
+        offset = int(entry["offset"])
+        return self.segment(int(entry["segment"]))[offset : offset + int(entry["length"])]
+
+    def add(self, source_hash, source):
+        """Add a source. It is written on the next flush."""
+        if not source_hash in self:
+            self.pending[source_hash.encode("ascii")] = bytes(source)
+
+    def flush(self):
+        """Append the pending sources to the segment files."""
+        if len(self.pending) == 0:
+            return
+
+        with locked(self.path):
+            self.load()
+            pending = [
+                (key, source) for key, source in self.pending.items() if self.find(key) == None
+            ]
+
+            segment = int(self.index["segment"].max()) if len(self.index) > 0 else 0
+            entries = np.zeros(len(pending), dtype=INDEX_DTYPE)
+            f = open(self.segment_path(segment), "ab")
+            try:
+                for idx, (key, source) in enumerate(pending):
+                    if f.tell() > 0 and f.tell() + len(source) > SEGMENT_SIZE:
+                        os.fsync(f.fileno())
+                        f.close()
+                        segment += 1
+                        f = open(self.segment_path(segment), "ab")
+                    entries[idx] = (key, segment, f.tell(), len(source))
+                    f.write(source)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+            entries = np.concatenate([self.index, entries])
+            entries = entries[np.argsort(entries["hash"], kind="stable")]
+            tmp_path = self.path / "index.tmp.npy"
+            np.save(tmp_path, entries)
+            os.replace(tmp_path, self.index_path)
+
+        self.pending = {}
+        self.load()
+
+
+class FunctionSources:
+    """Sources of a function database. Sources are read from the source store
+    if the database has been packed and from the function directories
+    otherwise.
+    """
+
+    def __init__(self, database, path=None):
+        self.database = database
+        path = Path(path) if path != None else sources_path(database.abspath)
+        self.store = SourceStore(path) if path.exists() else None
+
+    def get(self, function_id):
+        """The source of a function as bytes-like object."""
+        if self.store != None and function_id in self.store:
+            return self.store.get(function_id)
+        with open(self.database[function_id].abspath / "source", "rb") as f:
+            return f.read()
+
+    def read(self, function_id):
+        """The source of a function as string, like utils.fread."""
+        source = bytes(self.get(function_id)).decode("utf-8", errors="ignore")
+        return source.replace("\r\n", "\n").replace("\r", "\n")
+
+    def write(self, function_id, fpath):
+        """Write the source of a function to a file."""
+        with open(fpath, "wb") as f:
+            f.write(self.get(function_id))
+
+    def fpath(self, function_id, directory):
+        """Path of a file with the source of a function. Packed sources are
+        written to the directory.
+        """
+        if self.store != None and function_id in self.store:
+            fpath = Path(directory) / f"{function_id}.c"
+            self.write(function_id, fpath)
+            return fpath
+        return self.database[function_id].abspath / "source"
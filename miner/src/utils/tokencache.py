@@ -0,0 +1,117 @@
+""" On-disk cache of token ids for the transformer based metrics.
+
+Functions are content-addressed by the md5 hash of their source, so the token
+ids of a function only depend on its hash and the tokenizer. For each
+tokenizer the cache holds a directory with
+
+    tokens.bin  all token ids as one memory-mapped uint32 array, and
+    index.bin   the (hash, offset, length) of each cached function.
+
+Both files are only ever appended to, the token ids before their index
+entries, so that readers can safely memory-map them while another process
+adds new functions. Readers ignore a partially written index entry.
+"""
+
+import os
+import numpy as np
+import transformers
+from hashlib import md5
+from pathlib import Path
+
+from utils.utils import locked
+
+
+INDEX_DTYPE = np.dtype([("hash", "S32"), ("offset", "<u8"), ("length", "<u4")])
+TOKEN_DTYPE = np.dtype("<u4")
+
+
+def tokenizer_key(tokenizer):
+    """Identify the tokenizer, including everything that changes its output."""
+    vocab = sorted(tokenizer.get_vocab().items())
+    key = "\n".join(
+        [
+            tokenizer.__class__.__name__,
+            tokenizer.name_or_path,
+            str(tokenizer.model_max_length),
+            transformers.__version__,
+            repr(vocab),
+        ]
+    )
+    return md5(key.encode("utf-8")).hexdigest()
+
+
+class TokenCache:
+    def __init__(self, path, tokenizer):
+        self.tokenizer = tokenizer
+        self.path = Path(path) / tokenizer_key(tokenizer)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.tokens_path = self.path / "tokens.bin"
+        self.index_path = self.path / "index.bin"
+        self.pending = {}
+        self.load()
+
+    def load(self):
+        if self.index_path.exists():
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            # Skip an entry which is still being appended
+            size = len(data) // INDEX_DTYPE.itemsize * INDEX_DTYPE.itemsize
+            index = np.frombuffer(data[:size], dtype=INDEX_DTYPE)
+        else:
+            index = np.zeros(0, dtype=INDEX_DTYPE)
+        self.index = {
+            entry["hash"]: (int(entry["offset"]), int(entry["length"]))
+            for entry in index
+        }
+        size = max((offset + length for offset, length in self.index.values()), default=0)
+        if size > 0:
+            self.tokens = np.memmap(self.tokens_path, dtype=TOKEN_DTYPE, mode="r", shape=(size,))
+        else:
+            self.tokens = np.zeros(0, dtype=TOKEN_DTYPE)
+
+    def __contains__(self, source_hash):
+        key = source_hash.encode("ascii")
+        return key in self.index or key in self.pending
+
+    def get(self, source_hash, default=None):
+        """Return the token ids of a function as a read-only array view."""
+        key = source_hash.encode("ascii")
+        if key in self.pending:
+            return self.pending[key]
+        if not key in self.index:
+            return default
+        offset, length = self.index[key]
+        return self.tokens[offset : offset + length]
+
+    def tokenize(self, source_hashes, sources):
+        """Tokenize and add the given sources."""
+        token_ids = self.tokenizer(list(sources), truncation=True)["input_ids"]
+        for source_hash, ids in zip(source_hashes, token_ids):
+            self.pending[source_hash.encode("ascii")] = np.array(ids, dtype=TOKEN_DTYPE)
+
+    def flush(self):
+        """Append the pending token ids to the cache files."""
+        if len(self.pending) == 0:
+            return
+
+        with locked(self.path):
+            self.load()
+            pending = [
+                (key, ids) for key, ids in self.pending.items() if not key in self.index
+            ]
+
+            with open(self.tokens_path, "ab") as f:
+                offset = f.tell() // TOKEN_DTYPE.itemsize
+                entries = np.zeros(len(pending), dtype=INDEX_DTYPE)
+                for idx, (key, ids) in enumerate(pending):
+                    entries[idx] = (key, offset, len(ids))
+                    f.write(ids.tobytes())
+                    offset += len(ids)
+                f.flush()
+                os.fsync(f.fileno())
+
+            with open(self.index_path, "ab") as f:
+                f.write(entries.tobytes())
+
+        self.pending = {}
+        self.load()
@@ -7,12 +7,14 @@ import random
 import base64 as b64
 import subprocess
 import functools as ft
+import fcntl
 from cliffs_delta import cliffs_delta as lib_cliffs_delta
 from scipy.stats import mannwhitneyu as lib_mannwhitneyu
 #from toolz import curry
 #from toolz.curried import compose_left, map, filter, do, groupby, first, concat, reduce
 #from itertools import starmap
 from hashlib import md5
+from contextlib import contextmanager
 from tempfile import TemporaryDirectory
 from pathlib import Path
 
@@ -149,10 +151,26 @@ def json_read(fpath):
 #    )(fpath)
 
 
-#@curry
-#def json_write(fpath, data):
-#    compose_left(json.dumps, fwrite(fpath))(data)
-#    return data
+def json_write(fpath, data):
+    """Write the data to a temporary file and rename it, so that readers never
+    see a partially written file.
+    """
+    tmp_path = Path(f"{fpath}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, fpath)
+    return data
+
+
+@contextmanager
+def locked(directory):
+    """Hold the exclusive lock of a directory which several processes append
+    to. Whatever was read before taking the lock might have been extended by
+    another process in the meantime and has to be read again.
+    """
+    with open(Path(directory) / "lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
 
 
 #@curry